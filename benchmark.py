@@ -0,0 +1,415 @@
+"""
+Benchmarks for googlecheckout.
+
+    python benchmark.py [-n NUMBER] [-o results.json] [-c previous.json]
+
+measures the throughput of each stage of handling a notification (auth 
+check, peek, parse, dispatch, handshake, the whole post) over a synthetic
+corpus, the size of the parsed notifications and the command XML 
+serializer used by the Order methods (compared with the minidom document 
+building it replaced, checking both produce identical bytes). Results can
+be written as JSON and compared with an earlier run.
+
+    python benchmark.py corpus notifications.jsonl [-s SIZE]
+
+writes a synthetic corpus that can be used with "googlecheckout.py replay".
+"""
+import base64
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+import timeit
+from xml.dom.minidom import getDOMImplementation
+
+import googlecheckout
+
+# the commands benchmarked as (method, args, kwargs)
+COMMANDS = [
+    ("authorize", (), {}),
+    ("cancel", (), {"reason": "customer sounds dodgey", "comment": "a & b"}),
+    ("refund", ("it's all squishy",), {"amount": 10, "comment": "<sorry>"}),
+    ("charge_and_ship", (), {"amount": "12.50", "carrier": "FEDEX", "carrier_id": "123456"}),
+]
+
+def capture_order_class(currency="USD"):
+    "an Order class that keeps the command XML instead of sending it"
+    class CaptureOrder(googlecheckout.Client("1234567890", "key", currency=currency)):
+        def _request(self, xml):
+            self.xml = xml
+    return CaptureOrder
+
+def dom_command_xml(order_number, currency, method, *args, **kwargs):
+    "the XML for a command built the way the Order methods used to (minidom)"
+    doc = getDOMImplementation().createDocument(None, {
+        "authorize": "authorize-order",
+        "cancel": "cancel-order",
+        "refund": "refund-order",
+        "charge_and_ship": "charge-and-ship-order"}[method], None)
+    doc.documentElement.setAttribute("xmlns", "http://checkout.google.com/schema/2")
+    doc.documentElement.setAttribute("google-order-number", order_number)
+    def text(parent, tag, value, currency=None):
+        el = doc.createElement(tag)
+        if currency is not None:
+            el.setAttribute("currency", currency)
+        el.appendChild( doc.createTextNode(value) )
+        parent.appendChild(el)
+    if method == "cancel":
+        text(doc.documentElement, "reason", str(kwargs.get("reason", "no reason given")))
+        if kwargs.get("comment"):
+            text(doc.documentElement, "comment", str(kwargs["comment"]))
+    elif method == "refund":
+        if kwargs.get("amount") is not None:
+            text(doc.documentElement, "amount", str(kwargs["amount"]), currency)
+        text(doc.documentElement, "reason", str(args[0]))
+        if kwargs.get("comment"):
+            text(doc.documentElement, "comment", str(kwargs["comment"]))
+    elif method == "charge_and_ship":
+        if kwargs.get("amount") is not None:
+            text(doc.documentElement, "amount", str(kwargs["amount"]), currency)
+        if kwargs.get("carrier") is not None or kwargs.get("carrier_id") is not None:
+            tel = doc.createElement("tracking-data")
+            if kwargs.get("carrier") is not None:
+                text(tel, "carrier", kwargs["carrier"])
+            if kwargs.get("carrier_id") is not None:
+                text(tel, "tracking-number", kwargs["carrier_id"])
+            el = doc.createElement("tracking-data-list")
+            el.appendChild(tel)
+            doc.documentElement.appendChild(el)
+    return doc.toxml("utf-8")
+
+def bench_command_xml(number=2000):
+    "returns {command: (dom_seconds, template_seconds)} for number runs"
+    order = capture_order_class()("859558483052501")
+    results = {}
+    for method, args, kwargs in COMMANDS:
+        def template():
+            getattr(order, method)(*args, **kwargs)
+            return order.xml
+        dom = lambda: dom_command_xml(order.order_number, order.currency, method, *args, **kwargs)
+        if template() != dom():
+            raise AssertionError("%s XML differs:\n%s\n%s" % (method, template(), dom()))
+        results[method] = (timeit.timeit(dom, number=number), timeit.timeit(template, number=number))
+    return results
+
+# synthetic notifications
+
+MERCHANT_ID = "1234567890"
+MERCHANT_KEY = "HsYXFoZfHAqyLcCRYeH8qQ"
+
+NOTIFICATION_TYPES = [
+    'new-order-notification',
+    'risk-information-notification',
+    'order-state-change-notification',
+    'charge-amount-notification',
+    'authorization-amount-notification',
+    'refund-amount-notification',
+    'chargeback-amount-notification',
+]
+
+_ADDRESS = """<%(tag)s>
+    <contact-name>John Smith</contact-name>
+    <email>johnsmith@example.com</email>
+    <address1>10 Example Road</address1>
+    <city>Sampleville</city>
+    <region>CA</region>
+    <postal-code>94141</postal-code>
+    <country-code>US</country-code>
+    <phone>5555551234</phone>
+  </%(tag)s>"""
+
+_ITEM = """<item>
+        <merchant-item-id>SKU%(i)05d</merchant-item-id>
+        <item-name>Dry Food Pack AA%(i)d</item-name>
+        <item-description>A pack of highly nourishing dried food for emergency.</item-description>
+        <unit-price currency="%(currency)s">%(price)s</unit-price>
+        <quantity>%(quantity)d</quantity>
+      </item>"""
+
+def generate_notification(notification_type, items=1, serial_number=None, order_number=None, currency="USD"):
+    """returns the XML for a synthetic notification of notification_type. 
+    new-order-notifications get a shopping-cart with items items"""
+    rnd = random.Random(serial_number)
+    values = {
+        'type': notification_type,
+        'serial': serial_number or "%08x-5a4b-4c3d-8e2f-%012x" % (rnd.getrandbits(32), rnd.getrandbits(48)),
+        'order': order_number or str(rnd.randint(10**14, 10**15 - 1)),
+        'currency': currency,
+        'timestamp': "2007-03-19T15:06:26.051Z",
+        'amount': "%.2f" % (rnd.randint(100, 100000) / 100.0),
+    }
+    if notification_type == 'new-order-notification':
+        values['items'] = "\n      ".join(_ITEM % {'i': i, 'currency': currency, 
+            'price': "%.2f" % (rnd.randint(100, 10000) / 100.0), 'quantity': rnd.randint(1, 5)} for i in range(items))
+        values['buyer_shipping'] = _ADDRESS % {'tag': 'buyer-shipping-address'}
+        values['buyer_billing'] = _ADDRESS % {'tag': 'buyer-billing-address'}
+        body = """<shopping-cart>
+    <items>
+      %(items)s
+    </items>
+    <merchant-private-data><note>private</note></merchant-private-data>
+  </shopping-cart>
+  %(buyer_shipping)s
+  %(buyer_billing)s
+  <buyer-marketing-preferences><email-allowed>false</email-allowed></buyer-marketing-preferences>
+  <order-adjustment>
+    <total-tax currency="%(currency)s">0.0</total-tax>
+    <shipping><flat-rate-shipping-adjustment><shipping-name>SuperShip</shipping-name>
+      <shipping-cost currency="%(currency)s">9.95</shipping-cost></flat-rate-shipping-adjustment></shipping>
+  </order-adjustment>
+  <order-total currency="%(currency)s">%(amount)s</order-total>
+  <fulfillment-order-state>NEW</fulfillment-order-state>
+  <financial-order-state>REVIEWING</financial-order-state>
+  <buyer-id>294873009217523</buyer-id>"""
+    elif notification_type == 'risk-information-notification':
+        body = """<risk-information>
+    <eligible-for-protection>true</eligible-for-protection>
+    %(billing)s
+    <avs-response>Y</avs-response>
+    <cvn-response>M</cvn-response>
+    <partial-cc-number>3719</partial-cc-number>
+    <ip-address>10.11.12.13</ip-address>
+    <buyer-account-age>6</buyer-account-age>
+  </risk-information>""" % {'billing': _ADDRESS % {'tag': 'billing-address'}}
+    elif notification_type == 'order-state-change-notification':
+        body = """<new-financial-order-state>CHARGING</new-financial-order-state>
+  <new-fulfillment-order-state>NEW</new-fulfillment-order-state>
+  <previous-financial-order-state>CHARGEABLE</previous-financial-order-state>
+  <previous-fulfillment-order-state>NEW</previous-fulfillment-order-state>"""
+    else:
+        field = notification_type[:-len('-notification')]
+        total = {'charge-amount': 'total-charge-amount', 'refund-amount': 'total-refund-amount',
+            'chargeback-amount': 'total-chargeback-amount', 'authorization-amount': None}[field]
+        body = """<latest-%(field)s currency="%%(currency)s">%%(amount)s</latest-%(field)s>""" % {'field': field}
+        if total:
+            body += """
+  <%(total)s currency="%%(currency)s">%%(amount)s</%(total)s>""" % {'total': total}
+        if field == 'authorization-amount':
+            body = body.replace('latest-authorization-amount', 'authorization-amount') + """
+  <authorization-expiration-date>2007-03-26T15:06:26.051Z</authorization-expiration-date>
+  <avs-response>Y</avs-response>
+  <cvn-response>M</cvn-response>"""
+    return ("""<?xml version="1.0" encoding="UTF-8"?>
+<%(type)s xmlns="http://checkout.google.com/schema/2" serial-number="%(serial)s">
+  <google-order-number>%(order)s</google-order-number>
+  """ + body + """
+  <timestamp>%(timestamp)s</timestamp>
+</%(type)s>""") % values
+
+def generate_corpus(size=1000, seed=0, max_items=1000):
+    """yields size synthetic notifications of every type. the new orders have 
+    carts of between 1 and max_items items (mostly small)"""
+    rnd = random.Random(seed)
+    orders = []
+    for i in range(size):
+        if not orders or rnd.random() < 0.2:
+            notification_type = 'new-order-notification'
+            orders.append(str(rnd.randint(10**14, 10**15 - 1)))
+        else:
+            notification_type = rnd.choice(NOTIFICATION_TYPES[1:])
+        items = min(max_items, int(rnd.paretovariate(1.0)))
+        yield generate_notification(notification_type, items=items, serial_number="serial-%d-%d" % (seed, i),
+            order_number=rnd.choice(orders) if notification_type != 'new-order-notification' else orders[-1])
+
+# notification handling stages
+
+class _Request(object):
+    def __init__(self, body):
+        self.body = body
+        self.headers = {'Authorization': "Basic " + base64.b64encode(MERCHANT_ID + ":" + MERCHANT_KEY)}
+
+class _Response(object):
+    def __init__(self):
+        self.headers = {}
+        self.out = self
+
+    def write(self, data):
+        pass
+
+class BenchmarkHandler(googlecheckout.NotificationHandler):
+    "a handler that reads a few fields of every notification type"
+    def merchant_details(self):
+        return (MERCHANT_ID, MERCHANT_KEY)
+
+    def new_order(self):
+        self.notification.google_order_number
+        self.notification.order_total
+        for item in self.notification.shopping_cart.items:
+            item.item_name
+
+    def order_state_change(self):
+        self.notification.google_order_number
+        self.notification.new_financial_order_state
+
+    def charge_amount(self):
+        self.notification.google_order_number
+        self.notification.total_charge_amount
+
+    def other(self):
+        self.notification.google_order_number
+        self.notification.timestamp
+
+    risk_information = refund_amount = chargeback_amount = authorization_amount = other
+
+def _handler(body, lazy=None):
+    "a BenchmarkHandler for body (lazy=None keeps the default lazy_notifications)"
+    handler = BenchmarkHandler()
+    if lazy is not None:
+        handler.lazy_notifications = lazy
+    handler.request = _Request(body)
+    handler.response = _Response()
+    handler.error = lambda code: None
+    return handler
+
+def _deep_size(obj, seen=None):
+    "approximate memory used by a parsed notification"
+    seen = seen if seen is not None else set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deep_size(k, seen) + _deep_size(dict.__getitem__(obj, k), seen) for k in obj.keys())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(_deep_size(v, seen) for v in obj)
+    elif hasattr(obj, 'children'):
+        size += _deep_size(obj.children, seen)
+    return size
+
+def bench_stages(bodies, repeat=3):
+    """returns {stage: notifications per second} for each stage of handling
+    the notifications in bodies (best of repeat runs). the handlers are 
+    prepared again for each run so lazy dispatch starts from a fresh parse"""
+    def stage(prepare, run):
+        best = None
+        for i in range(repeat):
+            handlers = [prepare(body) for body in bodies]
+            started = time.time()
+            for handler in handlers:
+                run(handler)
+            elapsed = time.time() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return len(bodies) / best if best else 0.0
+    def parsed(lazy):
+        def prepare(body):
+            handler = _handler(body, lazy)
+            handler._parse_notification()
+            return handler
+        return prepare
+    return {
+        'auth': stage(_handler, lambda h: h._check_request()),
+        'peek': stage(_handler, lambda h: googlecheckout.peek_notification(h.request.body)),
+        'parse_eager': stage(lambda b: _handler(b, False), lambda h: h._parse_notification()),
+        'parse_lazy': stage(lambda b: _handler(b, True), lambda h: h._parse_notification()),
+        'dispatch_eager': stage(parsed(False), lambda h: h._process_notification()),
+        'dispatch_lazy': stage(parsed(True), lambda h: h._process_notification()),
+        'handshake': stage(parsed(False), lambda h: h._handshake()),
+        'post': stage(_handler, lambda h: h.post()),
+    }
+
+def bench_cart_sizes(sizes=(1, 10, 100, 1000), repeat=3):
+    """returns {items: {'parse_eager', 'parse_lazy', 'post' (per second), 
+    'bytes', 'size_eager', 'size_lazy' (after dispatch)}} for new orders"""
+    results = {}
+    for items in sizes:
+        body = generate_notification('new-order-notification', items=items, serial_number=str(items))
+        number = max(1, 2000 // items)
+        def rate(lazy, run):
+            handler = _handler(body, lazy)
+            return number / min(timeit.repeat(lambda: run(handler), number=number, repeat=repeat))
+        eager, lazy = _handler(body, False), _handler(body, True)
+        eager._parse_notification()
+        lazy._parse_notification()
+        lazy._process_notification()
+        results[items] = {
+            'bytes': len(body),
+            'parse_eager': rate(False, lambda h: h._parse_notification()),
+            'parse_lazy': rate(True, lambda h: h._parse_notification()),
+            'post': rate(None, lambda h: h.post()),
+            'size_eager': _deep_size(eager.notification),
+            'size_lazy': _deep_size(lazy.notification),
+        }
+    return results
+
+def _git_revision():
+    try:
+        return subprocess.Popen(["git", "rev-parse", "HEAD"], stdout=subprocess.PIPE, 
+            stderr=subprocess.PIPE).communicate()[0].strip() or None
+    except OSError:
+        return None
+
+def run(number=2000, corpus_size=1000):
+    "run every benchmark returning the results as a JSON-able dict"
+    bodies = list(generate_corpus(corpus_size, max_items=100))
+    commands = bench_command_xml(number)
+    results = {
+        'revision': _git_revision(),
+        'python': platform.python_version(),
+        'time': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        'stages': bench_stages(bodies),
+        'carts': dict((str(k), v) for k, v in bench_cart_sizes().items()),
+        'command_xml': dict((method, {'minidom': number / dom, 'template': number / template})
+            for method, (dom, template) in commands.items()),
+    }
+    try:
+        import resource
+        results['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        pass
+    return results
+
+def _flatten(results, prefix=""):
+    "{'a': {'b': 1}} -> {'a.b': 1} for the numeric results"
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, prefix + key + "."))
+        elif isinstance(value, (int, long, float)):
+            flat[prefix + key] = value
+    return flat
+
+def report(results, previous=None):
+    "print results (and the change since previous results)"
+    flat = _flatten(results)
+    old = _flatten(previous) if previous else {}
+    print "revision %s, python %s" % (results['revision'], results['python'])
+    for key in sorted(flat):
+        line = "%-40s %14.1f" % (key, flat[key])
+        if old.get(key):
+            line += "  %+6.1f%%" % ((flat[key] - old[key]) * 100.0 / old[key])
+        print line
+
+def main(argv=None):
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [-n NUMBER] [-o OUTPUT] [-c PREVIOUS] | %prog corpus OUTPUT [-s SIZE]")
+    parser.add_option("-n", "--number", type="int", default=2000, help="iterations of the command XML benchmark")
+    parser.add_option("-o", "--output", help="write the results as JSON to this file")
+    parser.add_option("-c", "--compare", help="compare with the JSON results of an earlier run")
+    parser.add_option("-s", "--size", type="int", default=1000, help="number of notifications in the corpus")
+    options, args = parser.parse_args(argv)
+    if args and args[0] == 'corpus':
+        if len(args) != 2:
+            parser.error("expected: corpus OUTPUT")
+        f = open(args[1], 'w')
+        try:
+            for body in generate_corpus(options.size):
+                f.write(json.dumps({'body': body}) + "\n")
+        finally:
+            f.close()
+        return
+    results = run(options.number, options.size)
+    previous = None
+    if options.compare:
+        previous = json.load(open(options.compare))
+    report(results, previous)
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            json.dump(results, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,54 @@
 import base64
+import errno
+import hmac
+import json
 import logging
-from xml.dom import minidom, Node
-from xml.dom.minidom import getDOMImplementation,parseString
+import os
+import re
+import sys
+import tarfile
+from cStringIO import StringIO
+from xml.dom import Node
+from xml.parsers import expat
+from xml.dom.minidom import parseString
 import httplib
+import socket
+import threading
+import time
+import random
+import Queue
+from datetime import datetime, timedelta
+from decimal import Decimal
+from collections import OrderedDict
 
-# ignore load error of appengine for tests
+# sqlite3 is not available on appengine
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+# concurrent.futures is optional (the "futures" package on python 2)
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
+
+# ignore load error of appengine for tests (and use outside of appengine)
 try:
     from google.appengine.ext import webapp
 except:
     class webapp():
         pass
-    webapp.RequestHandler = object
+    class _RequestHandler(object):
+        "the parts of webapp.RequestHandler that NotificationHandler uses"
+        def initialize(self, request, response):
+            self.request = request
+            self.response = response
+
+        def error(self, code):
+            self.response.set_status(code)
+            self.response.clear()
+    webapp.RequestHandler = _RequestHandler
     
 
 class DotDict(dict):
@@ -30,6 +68,104 @@ class DotDict(dict):
     __setattr__= dict.__setitem__
     __delattr__= dict.__delitem__
     
+class _LazyElement(object):
+    "an unconverted element: a list of (name, value, currency) children"
+    __slots__ = ('children',)
+    def __init__(self, children):
+        self.children = children
+
+class _LazyList(list):
+    "a list of repeated elements that may still contain _LazyElements"
+
+class LazyDotDict(DotDict):
+    """A DotDict whose sub-elements are only converted when first accessed.
+
+    Behaves like the DotDict returned by node_to_dotdict but the conversion
+    of each subtree is deferred until it is read and then memoized, so a 
+    handler that only looks at a few fields never pays for the rest of
+    the notification (eg. a large shopping-cart)"""
+    def __init__(self, children):
+        dict.__init__(self)
+        for name, value, cur in children:
+            # same merge rule as _add_value without touching the values
+            if dict.__contains__(self, name) and (not hasattr(DotDict, name)
+                    or isinstance(getattr(self,name),(dict,basestring,list))):
+                existing = dict.__getitem__(self, name)
+                if isinstance(existing, list):
+                    existing.append(value)
+                else:
+                    dict.__setitem__(self, name, _LazyList([existing, value]))
+            else:
+                dict.__setitem__(self, name, value)
+            if cur:
+                dict.__setitem__(self, name+"_currency", cur)
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if type(value) is _LazyElement:
+            value = LazyDotDict(value.children)
+            dict.__setitem__(self, key, value)
+        elif type(value) is _LazyList:
+            value = [LazyDotDict(v.children) if type(v) is _LazyElement else v for v in value]
+            dict.__setitem__(self, key, value)
+        return value
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def materialize(self):
+        "convert everything that is left. returns self"
+        for key in self.keys():
+            value = self[key]
+            for v in (value if isinstance(value, list) else [value]):
+                if isinstance(v, LazyDotDict):
+                    v.materialize()
+        return self
+
+    # everything that exposes the raw values needs the full tree
+    def values(self):
+        return dict.values(self.materialize())
+    def itervalues(self):
+        return dict.itervalues(self.materialize())
+    def iteritems(self):
+        return dict.iteritems(self.materialize())
+    def viewvalues(self):
+        return dict.viewvalues(self.materialize())
+    def viewitems(self):
+        return dict.viewitems(self.materialize())
+    def pop(self, key, *default):
+        if key in self:
+            self[key]
+        return dict.pop(self, key, *default)
+    def popitem(self):
+        return dict.popitem(self.materialize())
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+        return dict.setdefault(self, key, default)
+    def copy(self):
+        return DotDict(self.materialize())
+    def __eq__(self, other):
+        return dict.__eq__(self.materialize(), other)
+    def __ne__(self, other):
+        return dict.__ne__(self.materialize(), other)
+    def __repr__(self):
+        return dict.__repr__(self.materialize())
+    def __reduce__(self):
+        return (DotDict, (), None, None, self.iteritems())
+
+def _add_value(d, name, value):
+    "add value to d under name. repeated names are collected into a list"
+    if name in d and isinstance(getattr(d,name),(dict,basestring,list)):
+        if isinstance(d[name],list):
+            d[name].append(value)
+        else:
+            d[name] = [d[name], value]
+    else:
+        d[name] = value
+
 def node_to_dotdict(self):
     """The google XML format is very simple so we can easily convert the 
     whole thing into a big dict. this function returns a DotDict
@@ -40,14 +176,7 @@ def node_to_dotdict(self):
             return node.nodeValue
         elif node.nodeType == Node.ELEMENT_NODE:
             name = node.nodeName.replace('-','_')
-            value = node_to_dotdict(node)
-            if name in d and isinstance(getattr(d,name),(dict,basestring,list)):
-                if isinstance(d[name],list):
-                    d[name].append(value)
-                else:
-                    d[name] = [d[name], value]
-            else:
-                d[name] = value
+            _add_value(d, name, node_to_dotdict(node))
             # special case for currency attribute
             # currency is prettymuch the only attribute
             # used. it is converted into TAGNAME_ATTRNAME
@@ -56,17 +185,413 @@ def node_to_dotdict(self):
                 d[name+"_currency"] = cur
     return d
 
+class NotificationParser(object):
+    """A single pass (expat) parser for notification XML.
+
+    Builds the same DotDict that node_to_dotdict would produce directly
+    from the parser events without creating a DOM first. The root tag and 
+    the serial-number attribute are picked up on the way. With lazy=True
+    the result is a LazyDotDict instead."""
+
+    def __init__(self, lazy=False):
+        self.lazy = lazy
+        self.notification_type = None
+        self.serial_number = None
+        self.notification = None
+        self._stack = []
+        self._text = []
+
+    def parse(self, xmlstr):
+        parser = expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = self._start
+        parser.EndElementHandler = self._end
+        parser.CharacterDataHandler = self._text.append
+        # comments and PIs split text nodes in the DOM so do the same here
+        parser.CommentHandler = self._flush
+        parser.ProcessingInstructionHandler = self._flush
+        # CDATA sections are not text nodes so node_to_dotdict skips them
+        parser.StartCdataSectionHandler = self._flush
+        parser.EndCdataSectionHandler = self._discard
+        parser.Parse(xmlstr, True)
+        return self
+
+    def _flush(self, *args):
+        "like the DOM only the first non-blank run of text counts"
+        if self._text:
+            if self._stack and self._stack[-1][2] is None:
+                data = u"".join(self._text)
+                if data.strip():
+                    self._stack[-1][2] = data
+            del self._text[:]
+
+    def _discard(self):
+        del self._text[:]
+
+    def _start(self, name, attrs):
+        self._flush()
+        if not self._stack:
+            self.notification_type = name.split(':')[-1]
+            self.serial_number = attrs.get("serial-number")
+        container = [] if self.lazy else DotDict()
+        self._stack.append([name.replace('-','_'), container, None, attrs.get("currency")])
+
+    def _end(self, name):
+        self._flush()
+        name, d, text, cur = self._stack.pop()
+        if text is not None:
+            value = text
+        elif not self.lazy:
+            value = d
+        elif not self._stack:
+            value = LazyDotDict(d)
+        else:
+            value = _LazyElement(d)
+        if not self._stack:
+            self.notification = value
+            return
+        parent = self._stack[-1][1]
+        if self.lazy:
+            parent.append((name, value, cur))
+            return
+        _add_value(parent, name, value)
+        if cur:
+            parent[name+"_currency"] = cur
+
+def parse_notification(xmlstr, lazy=False):
+    """parse notification XML in a single pass. returns a tuple of
+    (notification_type, serial_number, notification)"""
+    p = NotificationParser(lazy).parse(xmlstr)
+    return p.notification_type, p.serial_number, p.notification
+
 def xml_to_dotdict(xmlstr):
-    dom = minidom.parseString(xmlstr)
-    return node_to_dotdict(dom.documentElement)
+    return parse_notification(xmlstr)[2]
+
+def peek_order_number(xmlstr):
+    "returns the first google-order-number in a notification (or None)"
+    found = []
+    def start(name, attrs):
+        if name.split(':')[-1] == 'google-order-number':
+            found.append([])
+            parser.CharacterDataHandler = found[0].append
+    def end(name):
+        if found:
+            raise _StopParsing()
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    try:
+        parser.Parse(xmlstr, True)
+    except _StopParsing:
+        return u"".join(found[0]).strip()
+    return None
+
+class _StopParsing(Exception):
+    "raised from an expat handler to stop parsing early"
+
+def peek_notification(xmlstr):
+    """read only as far as the root element of a notification. returns a 
+    tuple of (notification_type, serial_number)"""
+    found = []
+    def start(name, attrs):
+        found.append((name.split(':')[-1], attrs.get("serial-number")))
+        raise _StopParsing()
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = start
+    try:
+        parser.Parse(xmlstr, True)
+    except _StopParsing:
+        pass
+    return found[0]
+
+# typed notification views
+
+def _lazy_get(node, name):
+    "look up name in a DotDict, LazyDotDict or unconverted element without converting anything"
+    if isinstance(node, list):
+        node = node[0] if node else None
+    if isinstance(node, dict):
+        return dict.get(node, name)
+    if type(node) is _LazyElement:
+        values = [value for n, value, cur in node.children if n == name]
+        if not values:
+            return None
+        return values[0] if len(values) == 1 else values
+    return None
+
+def _lazy_currency(node, name):
+    "the currency attribute of element name in node"
+    if isinstance(node, list):
+        node = node[0] if node else None
+    if isinstance(node, dict):
+        return dict.get(node, name + "_currency")
+    if type(node) is _LazyElement:
+        for n, value, cur in node.children:
+            if n == name and cur:
+                return cur
+    return None
+
+def _text(value):
+    if isinstance(value, list):
+        value = value[0]
+    return value if isinstance(value, basestring) else None
+
+def _to_amount(value):
+    value = _text(value)
+    return Decimal(value.strip()) if value is not None else None
+
+def _to_int(value):
+    value = _text(value)
+    return int(value) if value is not None else None
+
+def _to_bool(value):
+    value = _text(value)
+    return value.strip() == 'true' if value is not None else None
+
+_TIMESTAMP = re.compile(r"^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.(\d+))?(Z|([+-])(\d\d):?(\d\d))?$")
+
+def _to_timestamp(value):
+    """google checkout timestamps look like 2007-03-19T15:06:26.051Z or 
+    2007-12-31T23:59:59-05:00. returns a (naive) datetime in UTC"""
+    value = _text(value)
+    if value is None:
+        return None
+    match = _TIMESTAMP.match(value.strip())
+    if match is None:
+        raise ValueError("not a timestamp: %r" % value)
+    stamp, fraction, zone, sign, hours, minutes = match.groups()
+    result = datetime.strptime(stamp, "%Y-%m-%dT%H:%M:%S").replace(
+        microsecond=int((fraction + "000000")[:6]) if fraction else 0)
+    if sign:
+        offset = timedelta(hours=int(hours), minutes=int(minutes))
+        result = result - offset if sign == '+' else result + offset
+    return result
+
+_CONVERTERS = {
+    'text': _text,
+    'amount': _to_amount,
+    'int': _to_int,
+    'bool': _to_bool,
+    'timestamp': _to_timestamp,
+}
+
+class NotificationView(object):
+    """Base class for the typed notification views generated from 
+    NOTIFICATION_SCHEMAS. A view is a __slots__ object with amounts as 
+    Decimals, timestamps as UTC datetimes and the shopping-cart items as a
+    tuple. Values that can not be converted are left as the text google 
+    sent. Views are a conversion convenience built from a parsed 
+    notification (eager or lazy), which is still kept alongside them"""
+    __slots__ = ()
+    _getters = ()
+
+    def __init__(self, node):
+        for attr, get in self._getters:
+            setattr(self, attr, get(node))
+
+    def as_dict(self):
+        return dict((attr, getattr(self, attr)) for attr, get in self._getters)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.as_dict() == other.as_dict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, 
+            " ".join("%s=%r" % (attr, getattr(self, attr)) for attr, get in self._getters))
+
+def _compile_getter(path, kind):
+    "returns a function fetching and converting the value at path from a node"
+    if kind == 'currency':
+        def get(node):
+            for name in path[:-1]:
+                node = _lazy_get(node, name)
+            return _lazy_currency(node, path[-1])
+        return get
+    if isinstance(kind, tuple):
+        # ('tuple', ViewName): every element at path as a view
+        view = NOTIFICATION_VIEWS[kind[1]]
+        def convert(value):
+            if value is None:
+                return ()
+            return tuple(view(v) for v in (value if isinstance(value, list) else [value]))
+    elif kind in _CONVERTERS:
+        converter = _CONVERTERS[kind]
+        def convert(value):
+            try:
+                return converter(value)
+            except (ValueError, ArithmeticError):
+                # keep the text google sent rather than failing the notification
+                return _text(value)
+    else:
+        view = NOTIFICATION_VIEWS[kind]
+        convert = lambda value: view(value) if value is not None else None
+    def get(node):
+        for name in path:
+            node = _lazy_get(node, name)
+            if node is None:
+                break
+        return convert(node)
+    return get
+
+def _address_fields(prefix=()):
+    return [(name, prefix + (name,), 'text') for name in ('contact_name', 'company_name', 'email',
+        'address1', 'address2', 'city', 'region', 'postal_code', 'country_code', 'phone', 'fax')]
+
+def _common_fields():
+    return [('google_order_number', ('google_order_number',), 'text'),
+            ('timestamp', ('timestamp',), 'timestamp')]
+
+# the view classes to generate as (name, notification type or None, fields)
+# where each field is (attribute, path, kind). kind is a converter name, 
+# 'currency' (the currency attribute of the element at path), the name of 
+# another view or ('tuple', view name) for repeated elements
+NOTIFICATION_SCHEMAS = [
+    ('Address', None, _address_fields()),
+    ('Item', None, [
+        ('merchant_item_id', ('merchant_item_id',), 'text'),
+        ('item_name', ('item_name',), 'text'),
+        ('item_description', ('item_description',), 'text'),
+        ('unit_price', ('unit_price',), 'amount'),
+        ('currency', ('unit_price',), 'currency'),
+        ('quantity', ('quantity',), 'int')]),
+    ('NewOrderNotification', 'new-order-notification', _common_fields() + [
+        ('order_total', ('order_total',), 'amount'),
+        ('currency', ('order_total',), 'currency'),
+        ('financial_order_state', ('financial_order_state',), 'text'),
+        ('fulfillment_order_state', ('fulfillment_order_state',), 'text'),
+        ('buyer_id', ('buyer_id',), 'text'),
+        ('email_allowed', ('buyer_marketing_preferences', 'email_allowed'), 'bool'),
+        ('items', ('shopping_cart', 'items', 'item'), ('tuple', 'Item')),
+        ('buyer_shipping_address', ('buyer_shipping_address',), 'Address'),
+        ('buyer_billing_address', ('buyer_billing_address',), 'Address')]),
+    ('RiskInformationNotification', 'risk-information-notification', _common_fields() + [
+        ('eligible_for_protection', ('risk_information', 'eligible_for_protection'), 'bool'),
+        ('avs_response', ('risk_information', 'avs_response'), 'text'),
+        ('cvn_response', ('risk_information', 'cvn_response'), 'text'),
+        ('partial_cc_number', ('risk_information', 'partial_cc_number'), 'text'),
+        ('ip_address', ('risk_information', 'ip_address'), 'text'),
+        ('buyer_account_age', ('risk_information', 'buyer_account_age'), 'int'),
+        ('billing_address', ('risk_information', 'billing_address'), 'Address')]),
+    ('OrderStateChangeNotification', 'order-state-change-notification', _common_fields() + [
+        ('new_financial_order_state', ('new_financial_order_state',), 'text'),
+        ('new_fulfillment_order_state', ('new_fulfillment_order_state',), 'text'),
+        ('previous_financial_order_state', ('previous_financial_order_state',), 'text'),
+        ('previous_fulfillment_order_state', ('previous_fulfillment_order_state',), 'text'),
+        ('reason', ('reason',), 'text')]),
+    ('ChargeAmountNotification', 'charge-amount-notification', _common_fields() + [
+        ('latest_charge_amount', ('latest_charge_amount',), 'amount'),
+        ('total_charge_amount', ('total_charge_amount',), 'amount'),
+        ('currency', ('latest_charge_amount',), 'currency')]),
+    ('AuthorizationAmountNotification', 'authorization-amount-notification', _common_fields() + [
+        ('authorization_amount', ('authorization_amount',), 'amount'),
+        ('currency', ('authorization_amount',), 'currency'),
+        ('authorization_expiration_date', ('authorization_expiration_date',), 'timestamp'),
+        ('avs_response', ('avs_response',), 'text'),
+        ('cvn_response', ('cvn_response',), 'text')]),
+    ('RefundAmountNotification', 'refund-amount-notification', _common_fields() + [
+        ('latest_refund_amount', ('latest_refund_amount',), 'amount'),
+        ('total_refund_amount', ('total_refund_amount',), 'amount'),
+        ('currency', ('latest_refund_amount',), 'currency')]),
+    ('ChargebackAmountNotification', 'chargeback-amount-notification', _common_fields() + [
+        ('latest_chargeback_amount', ('latest_chargeback_amount',), 'amount'),
+        ('total_chargeback_amount', ('total_chargeback_amount',), 'amount'),
+        ('currency', ('latest_chargeback_amount',), 'currency')]),
+]
+
+# generated view classes by name and by notification type
+NOTIFICATION_VIEWS = {}
+
+def _build_views():
+    for name, notification_type, fields in NOTIFICATION_SCHEMAS:
+        attrs = tuple(attr for attr, path, kind in fields)
+        if notification_type is not None:
+            attrs += ('notification_type', 'serial_number')
+        view = type(name, (NotificationView,), {'__slots__': attrs, '__module__': __name__})
+        view._getters = tuple((attr, _compile_getter(path, kind)) for attr, path, kind in fields)
+        NOTIFICATION_VIEWS[name] = view
+        if notification_type is not None:
+            NOTIFICATION_VIEWS[notification_type] = view
+_build_views()
+
+def notification_view(notification_type, serial_number, notification):
+    """returns the typed view of a parsed notification (from parse_notification)
+    or None for notification types without a schema"""
+    view = NOTIFICATION_VIEWS.get(notification_type)
+    if view is None:
+        return None
+    view = view(notification)
+    view.notification_type = notification_type
+    view.serial_number = serial_number
+    return view
+
+def _xml_escape(data):
+    "escape text/attribute data the same way minidom writes it"
+    return data.replace("&", "&amp;").replace("<", "&lt;"). \
+                replace("\"", "&quot;").replace(">", "&gt;")
+
+# a notification-acknowledgment exactly as minidom would write it
+_ACK_TEMPLATE = ('<?xml version="1.0" encoding="utf-8"?>'
+    '<notification-acknowledgment serial-number="%s" xmlns="http://checkout.google.com/schema/2"/>')
+
+def acknowledgment_xml(serial_number):
+    "returns the (utf-8) notification-acknowledgment XML for serial_number"
+    serial_number = _xml_escape(serial_number)
+    if isinstance(serial_number, unicode):
+        serial_number = serial_number.encode("utf-8")
+    return _ACK_TEMPLATE % serial_number
 
 class Error(Exception):
     """Base class for exceptions in this module."""
 
+class OrderProcessingError(Error):
+    """Raised when the Order Processing API rejects a command. messages
+    holds the error-message values from the response"""
+    def __init__(self, msg, status=None, messages=()):
+        Error.__init__(self, msg)
+        self.status = status
+        self.messages = list(messages)
+
+class RetryableOrderError(OrderProcessingError):
+    """An Order Processing failure that may succeed if the command is sent 
+    again (server errors, rate limiting, timeouts and connection errors)"""
+
+class FatalOrderError(OrderProcessingError):
+    "An Order Processing command that was rejected and should not be retried"
+
+class OrderOutcomeUnknownError(OrderProcessingError):
+    """A command was sent but no response arrived (eg. it timed out), so it
+    may or may not have been carried out. These are never retried as charge
+    and refund are not idempotent: check the order state first"""
+
+class CircuitOpenError(RetryableOrderError):
+    "Raised without sending a command while the circuit breaker for the host is open"
+
 class IgnoreNotification(Error):
     """Base class for exceptions raised to ackknowledge 
     by not do anything with a notification"""
     
+def handles(*notification_types):
+    """decorator registering a NotificationHandler method as a handler for
+    one or more notification types (including types NotificationHandler has
+    no method for):
+
+        class MyNotificationHandler(NotificationHandler):
+
+            @handles('charge-amount-notification', 'refund-amount-notification')
+            def update_balance(self):
+                ...
+
+    when several methods handle the same type they are called in the order
+    they are defined (base classes first). overriding a registered method 
+    keeps its registration"""
+    def register(func):
+        func._notification_types = getattr(func, '_notification_types', ()) + notification_types
+        return func
+    return register
+
 def get_list_from_value(notification_value):
     "Checks to see if value in notification dict is a list or unicode. Returns list of value(s) as integers."
     if type(notification_value) == list:
@@ -75,6 +600,421 @@ def get_list_from_value(notification_value):
     
 
     
+class Metrics(object):
+    """Base class for instrumentation sinks. Set NotificationHandler.metrics 
+    (or Order.metrics) to an instance to record:
+
+        notifications_total{type,outcome}       counter
+        notification_stage_seconds{type,stage}  auth, peek, parse, handler, handshake
+                                            and remote_order (part of handler)
+        notification_seconds{type,outcome}      the whole request
+        notification_body_bytes{type}
+        notification_cart_items{type}           new-order-notifications only
+        order_requests_total{command,status}    counter
+        order_request_seconds{command,status}
+
+    outcomes are handled, ignored, duplicate, queued, skipped (by middleware),
+    unauthorized, bad_request and error. Subclasses implement increment and
+    observe"""
+
+    def increment(self, name, labels):
+        "add one to the counter name"
+        raise Error("Missing metrics increment. define a %s.increment method to count events" % self.__class__.__name__)
+
+    def observe(self, name, value, labels):
+        "record a value (a time in seconds or a size) for name"
+        raise Error("Missing metrics observe. define a %s.observe method to record values" % self.__class__.__name__)
+
+class LoggingMetrics(Metrics):
+    "A Metrics sink that logs every value"
+    def __init__(self, level=logging.DEBUG):
+        self.level = level
+
+    def _labels(self, labels):
+        return ",".join("%s=%s" % item for item in sorted(labels.items()))
+
+    def increment(self, name, labels):
+        logging.log(self.level, "GoogleNotification metric: %s{%s} +1", name, self._labels(labels))
+
+    def observe(self, name, value, labels):
+        logging.log(self.level, "GoogleNotification metric: %s{%s} %s", name, self._labels(labels), value)
+
+class HistogramMetrics(Metrics):
+    """A Metrics sink that aggregates counters and histograms in memory.
+    values for names ending in _seconds go into time_buckets, everything 
+    else into size_buckets"""
+    time_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    size_buckets = (1, 10, 100, 1000, 10000, 100000, 1000000, 10000000)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def _key(self, name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def increment(self, name, labels):
+        key = self._key(name, labels)
+        self._lock.acquire()
+        try:
+            self.counters[key] = self.counters.get(key, 0) + 1
+        finally:
+            self._lock.release()
+
+    def observe(self, name, value, labels):
+        key = self._key(name, labels)
+        self._lock.acquire()
+        try:
+            if key not in self.histograms:
+                buckets = self.time_buckets if name.endswith('_seconds') else self.size_buckets
+                self.histograms[key] = {'buckets': buckets, 'counts': [0] * len(buckets), 
+                    'count': 0, 'sum': 0, 'min': value, 'max': value}
+            h = self.histograms[key]
+            h['count'] += 1
+            h['sum'] += value
+            h['min'] = min(h['min'], value)
+            h['max'] = max(h['max'], value)
+            for i, bound in enumerate(h['buckets']):
+                if value <= bound:
+                    h['counts'][i] += 1
+                    break
+        finally:
+            self._lock.release()
+
+    def counter(self, name, **labels):
+        "returns the current value of a counter"
+        return self.counters.get(self._key(name, labels), 0)
+
+    def histogram(self, name, **labels):
+        "returns the dict of count, sum, min, max and bucket counts for a histogram (or None)"
+        return self.histograms.get(self._key(name, labels))
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self.counters.clear()
+            self.histograms.clear()
+        finally:
+            self._lock.release()
+
+class PrometheusMetrics(HistogramMetrics):
+    """A HistogramMetrics that can export its values in the prometheus text
+    format, eg. to serve from a /metrics handler"""
+    prefix = "googlecheckout_"
+
+    def _labels(self, labels, extra=()):
+        labels = list(labels) + list(extra)
+        if not labels:
+            return ""
+        return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) 
+            for k, v in labels)
+
+    def export(self):
+        "returns the counters and histograms in the prometheus text format"
+        self._lock.acquire()
+        try:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, dict(h, counts=list(h['counts']))) for key, h in self.histograms.items())
+        finally:
+            self._lock.release()
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE %s%s counter" % (self.prefix, name))
+            lines.append("%s%s%s %s" % (self.prefix, name, self._labels(labels), value))
+        for (name, labels), h in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE %s%s histogram" % (self.prefix, name))
+            total = 0
+            for bound, count in zip(h['buckets'], h['counts']):
+                total += count
+                lines.append("%s%s_bucket%s %s" % (self.prefix, name, self._labels(labels, [('le', bound)]), total))
+            lines.append("%s%s_bucket%s %s" % (self.prefix, name, self._labels(labels, [('le', '+Inf')]), h['count']))
+            lines.append("%s%s_sum%s %s" % (self.prefix, name, self._labels(labels), h['sum']))
+            lines.append("%s%s_count%s %s" % (self.prefix, name, self._labels(labels), h['count']))
+        return "\n".join(lines) + "\n"
+
+class SerialStore(object):
+    """Base class for stores that remember the outcome of processing each
+    notification serial-number. Subclasses implement get and set"""
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def get(self, serial_number):
+        "returns the recorded status for serial_number or None"
+        raise Error("Missing serial store get. define a %s.get method to return the status of a serial-number" % self.__class__.__name__)
+
+    def set(self, serial_number, status):
+        "record the status (DONE or FAILED) for serial_number"
+        raise Error("Missing serial store set. define a %s.set method to record the status of a serial-number" % self.__class__.__name__)
+
+class MemorySerialStore(SerialStore):
+    """An in-process SerialStore keeping the most recently used maxsize 
+    serial numbers for ttl seconds"""
+    def __init__(self, maxsize=10000, ttl=24*60*60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._serials = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, serial_number):
+        self._lock.acquire()
+        try:
+            if serial_number not in self._serials:
+                return None
+            status, expires = self._serials.pop(serial_number)
+            if expires < time.time():
+                return None
+            self._serials[serial_number] = (status, expires)
+            return status
+        finally:
+            self._lock.release()
+
+    def set(self, serial_number, status):
+        self._lock.acquire()
+        try:
+            self._serials.pop(serial_number, None)
+            self._serials[serial_number] = (status, time.time() + self.ttl)
+            while len(self._serials) > self.maxsize:
+                self._serials.popitem(last=False)
+        finally:
+            self._lock.release()
+
+class SQLiteSerialStore(SerialStore):
+    """A SerialStore persisted in a sqlite database at path. Entries older
+    than ttl seconds are ignored and removed by purge()"""
+    def __init__(self, path, ttl=24*60*60):
+        if sqlite3 is None:
+            raise Error("SQLiteSerialStore requires the sqlite3 module")
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS serials "
+            "(serial_number TEXT PRIMARY KEY, status TEXT, updated REAL)")
+        self._db.commit()
+
+    def get(self, serial_number):
+        self._lock.acquire()
+        try:
+            row = self._db.execute("SELECT status FROM serials WHERE serial_number = ? AND updated >= ?",
+                (serial_number, time.time() - self.ttl)).fetchone()
+        finally:
+            self._lock.release()
+        return row[0] if row else None
+
+    def set(self, serial_number, status):
+        self._lock.acquire()
+        try:
+            self._db.execute("INSERT OR REPLACE INTO serials VALUES (?, ?, ?)", 
+                (serial_number, status, time.time()))
+            self._db.commit()
+        finally:
+            self._lock.release()
+
+    def purge(self):
+        "remove expired entries"
+        self._lock.acquire()
+        try:
+            self._db.execute("DELETE FROM serials WHERE updated < ?", (time.time() - self.ttl,))
+            self._db.commit()
+        finally:
+            self._lock.release()
+
+class OrderState(object):
+    "The state of an order as known from the notifications received for it"
+    fields = ('google_order_number', 'financial_order_state', 'fulfillment_order_state', 
+        'currency', 'order_total', 'total_authorized', 'total_charged', 'total_refunded', 
+        'total_chargeback', 'last_serial_number', 'timestamp', 'updated')
+    __slots__ = fields
+
+    def __init__(self, google_order_number, **values):
+        for field in self.fields:
+            setattr(self, field, values.get(field))
+        self.google_order_number = google_order_number
+        for field in ('total_authorized', 'total_charged', 'total_refunded', 'total_chargeback'):
+            if getattr(self, field) is None:
+                setattr(self, field, Decimal(0))
+        # field -> timestamp of the notification that last set it
+        if self.updated is None:
+            self.updated = {}
+
+    def as_dict(self):
+        return dict((field, getattr(self, field)) for field in self.fields)
+
+    def __repr__(self):
+        return "<OrderState %s %s/%s>" % (self.google_order_number, 
+            self.financial_order_state, self.fulfillment_order_state)
+
+def _older(timestamp, other):
+    "true if notification timestamp is before other (timestamps that can not be read are never older)"
+    if timestamp is None or other is None:
+        return False
+    try:
+        return _to_timestamp(timestamp) < _to_timestamp(other)
+    except ValueError:
+        return False
+
+class OrderStateStore(object):
+    """
+    A local projection of order states built from the notifications, indexed
+    by google-order-number. Set it as NotificationHandler.order_states and
+    handlers can read self.order_state instead of looking the order up:
+
+        class MyNotificationHandler(NotificationHandler):
+            order_states = googlecheckout.OrderStateStore('/var/lib/checkout/orders.db')
+
+            def charge_amount(self):
+                if self.order_state.total_charged >= self.order_state.order_total:
+                    ...
+
+    The states are kept in memory and, if a path is given, written through
+    to a sqlite database they are loaded from on startup. Only the absolute 
+    values from the notifications (states and running totals) are stored and
+    each field remembers the timestamp of the notification that set it, so 
+    applying a notification again, or an older one, has no effect.
+    """
+    # notification type -> ((notification field, OrderState field), ...)
+    projections = {
+        'new-order-notification': (('financial_order_state', 'financial_order_state'), 
+            ('fulfillment_order_state', 'fulfillment_order_state'), ('order_total', 'order_total')),
+        'order-state-change-notification': (('new_financial_order_state', 'financial_order_state'), 
+            ('new_fulfillment_order_state', 'fulfillment_order_state')),
+        'authorization-amount-notification': (('authorization_amount', 'total_authorized'),),
+        'charge-amount-notification': (('total_charge_amount', 'total_charged'),),
+        'refund-amount-notification': (('total_refund_amount', 'total_refunded'),),
+        'chargeback-amount-notification': (('total_chargeback_amount', 'total_chargeback'),),
+    }
+    amounts = ('order_total', 'total_authorized', 'total_charged', 'total_refunded', 'total_chargeback')
+
+    def __init__(self, path=None):
+        self._lock = threading.Lock()
+        self._states = {}
+        self._db = None
+        if path is not None:
+            if sqlite3 is None:
+                raise Error("OrderStateStore persistence requires the sqlite3 module")
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS order_states (%s, PRIMARY KEY (google_order_number))" %
+                ", ".join("%s TEXT" % field for field in OrderState.fields))
+            self._db.commit()
+            for row in self._db.execute("SELECT %s FROM order_states" % ", ".join(OrderState.fields)):
+                values = dict(zip(OrderState.fields, row))
+                for field in self.amounts:
+                    if values[field] is not None:
+                        values[field] = Decimal(values[field])
+                values['updated'] = json.loads(values['updated']) if values['updated'] else {}
+                self._states[values['google_order_number']] = OrderState(**values)
+
+    def get(self, google_order_number):
+        "returns the OrderState for google_order_number or None"
+        return self._states.get(google_order_number)
+
+    def __len__(self):
+        return len(self._states)
+
+    def __iter__(self):
+        return iter(self._states.values())
+
+    def apply(self, notification_type, notification, serial_number=None):
+        "update the state of the order a notification is for. returns the OrderState"
+        order_number = notification.get('google_order_number')
+        if order_number is None:
+            return None
+        self._lock.acquire()
+        try:
+            state = self._states.get(order_number)
+            if state is None:
+                state = self._states[order_number] = OrderState(order_number)
+            timestamp = notification.get('timestamp')
+            if not isinstance(timestamp, basestring):
+                timestamp = None
+            for name, field in self.projections.get(notification_type, ()):
+                if _older(timestamp, state.updated.get(field)):
+                    # a redelivered notification that has been superseded
+                    continue
+                value = notification.get(name)
+                if isinstance(value, list):
+                    value = value[-1]
+                if value is None or isinstance(value, dict):
+                    continue
+                if field in self.amounts:
+                    value = Decimal(value.strip())
+                    state.currency = notification.get(name + '_currency', state.currency)
+                setattr(state, field, value)
+                if timestamp is not None:
+                    state.updated[field] = timestamp
+            if not _older(timestamp, state.timestamp):
+                state.last_serial_number = serial_number or state.last_serial_number
+                state.timestamp = timestamp or state.timestamp
+            if self._db is not None:
+                values = state.as_dict()
+                values['updated'] = json.dumps(values['updated'])
+                self._db.execute("INSERT OR REPLACE INTO order_states (%s) VALUES (%s)" % (
+                    ", ".join(OrderState.fields), ", ".join("?" * len(OrderState.fields))),
+                    [None if values[f] is None else unicode(values[f]) for f in OrderState.fields])
+                self._db.commit()
+            return state
+        finally:
+            self._lock.release()
+
+def _compare_digest(a, b):
+    "constant time string comparison (for pythons before 2.7.7)"
+    if len(a) != len(b):
+        b = a
+        result = 1
+    else:
+        result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+compare_digest = getattr(hmac, 'compare_digest', _compare_digest)
+
+class MerchantCredentials(object):
+    """Checks the Authorization header of incoming notifications against one
+    or more (merchant_id, merchant_key) accounts. The accounts are indexed
+    by merchant id once and the merchant key from the header is compared in
+    constant time"""
+
+    def __init__(self, accounts):
+        self.accounts = [(str(mid), str(mkey)) for mid, mkey in accounts]
+        if not self.accounts:
+            raise Error("no merchant accounts")
+        self._accounts = dict((account[0], account) for account in self.accounts)
+        # compared against when the merchant id is unknown so that takes as long
+        self._unknown = (None, self.accounts[0][1])
+
+    def account(self, merchant_id):
+        "returns the (merchant_id, merchant_key) for merchant_id"
+        try:
+            return self._accounts[str(merchant_id)]
+        except KeyError:
+            raise Error("unknown merchant id %s" % merchant_id)
+
+    def verify(self, header):
+        "returns the matching (merchant_id, merchant_key) or None"
+        if not header:
+            return None
+        try:
+            header = str(header).strip()
+            scheme, _, token = header.partition(" ")
+            if scheme.lower() != "basic":
+                return None
+            merchant_id, sep, merchant_key = base64.b64decode(token.strip()).partition(":")
+        except (TypeError, ValueError, UnicodeError):
+            # not ascii or not base64
+            return None
+        if not sep:
+            return None
+        account = self._accounts.get(merchant_id, self._unknown)
+        if not compare_digest(merchant_key, account[1]) or account[0] is None:
+            return None
+        return account
+
 class NotificationHandler(webapp.RequestHandler):
     """A base RequestHandler handler class for implimenting the google-checkout notification API.
 
@@ -172,60 +1112,148 @@ class NotificationHandler(webapp.RequestHandler):
     google-checkout to prevent re-sending.
     """
     
+    # convert parts of self.notification only when they are accessed. the
+    # values are then only converted through item/attribute access, so code
+    # copying the notification with dict() or update() should stay eager
+    lazy_notifications = False
+
+    # make self.notification a typed view (see NOTIFICATION_SCHEMAS) for the
+    # notification types that have one. self.raw_notification keeps the dict
+    typed_notifications = False
+
+    # a SerialStore used to acknowledge redelivered notifications without
+    # processing them again (eg. MemorySerialStore())
+    serial_store = None
+
+    # an OrderStateStore kept up to date from every processed notification.
+    # handlers can read the current order from self.order_state
+    order_states = None
+
+    # a NotificationQueue. if set notifications are stored and acknowledged
+    # straight away and a NotificationWorker processes them later
+    work_queue = None
+
+    # a Metrics sink for per-stage timings and outcome counters
+    metrics = None
+
+    # callables run before a notification is parsed as middleware(handler, call_next).
+    # handler.notification_type and handler.notification_serial_number are set,
+    # returning without calling call_next() acknowledges the notification
+    # without processing it
+    middleware = ()
+
+    # the method called for each notification type (see also @handles)
+    notification_methods = {
+        'new-order-notification': 'new_order',
+        'risk-information-notification': 'risk_information',
+        'order-state-change-notification': 'order_state_change',
+        'charge-amount-notification': 'charge_amount',
+        'authorization-amount-notification': 'authorization_amount',
+        'refund-amount-notification': 'refund_amount',
+        'chargeback-amount-notification': 'chargeback_amount',
+    }
+
     def merchant_details(self):
         "Return tuple of (merchant_id,merchant_key)"
         raise Error("Missing merchant details. define a %s.merchant_details method to return a tuple of (merchant_id,merchant_key)", self.__class__.__name__)
+
+    def merchant_accounts(self):
+        """Return a list of (merchant_id,merchant_key) tuples accepted by this
+        handler. Override this instead of merchant_details to serve several 
+        merchant accounts from one endpoint"""
+        return [self.merchant_details()]
     
-    def _parse_notification(self): 
+    def _parse_notification(self, body=None): 
         "All google notifications are parsed and categorized by type."
-        dom = minidom.parseString(self.request.body)
-        # store the notification type
-        self.notification_type = dom.childNodes[0].localName 
-        # convert the xml to a more python friendly format (a dict with dot-access)
-        self.notification = node_to_dotdict(dom.documentElement)
-        # get the serial number
-        try:
-            self.notification_serial_number = dom.childNodes[0].attributes["serial-number"].value
-        except KeyError:
+        if body is None:
+            body = self.request.body
+        # store the notification type and convert the xml to a more python 
+        # friendly format (a dict with dot-access) in a single pass
+        (self.notification_type,
+         self.notification_serial_number,
+         self.notification) = parse_notification(body, lazy=self.lazy_notifications)
+        # self.raw_notification is always the dict form
+        self.raw_notification = self.notification
+        if self.typed_notifications:
+            view = notification_view(self.notification_type, self.notification_serial_number, self.notification)
+            if view is not None:
+                self.notification = view
+        # check we got a serial number
+        if self.notification_serial_number is None:
             logging.error("GoogleNotification: notification body did not contain a serial-number field")
-            raise
-        # create a RemoteOrder (for interacting with Order Processing API)
-        self.remote_order = self._remote_order()
+            raise KeyError("serial-number")
+        # the RemoteOrder is only created if it is used
+        self.__dict__.pop('_remote_order_instance', None)
+
+    def _credentials(self):
+        "the MerchantCredentials for merchant_accounts(), built once per handler class"
+        cls = self.__class__
+        if '_credentials_cache' not in cls.__dict__:
+            cls._credentials_cache = MerchantCredentials(self.merchant_accounts())
+        return cls._credentials_cache
+
+    def _merchant_details(self):
+        """the merchant account the current notification was sent to. without
+        a request (or merchant id for replay) that is only known when there 
+        is a single account"""
+        account = self.__dict__.get('merchant_account')
+        if account is None:
+            accounts = self._credentials().accounts
+            if len(accounts) > 1:
+                raise Error("GoogleNotification: not known which of the %d merchant accounts notification %s was sent to" % (
+                    len(accounts), self.notification_serial_number))
+            account = accounts[0]
+        return account
         
     def _handshake(self):
         "Acknowledge receipt of notification."
-        doc = minidom.Document() 
-        ack = doc.createElement("notification-acknowledgment")
-        ack.setAttribute("xmlns","http://checkout.google.com/schema/2")
-        ack.setAttribute("serial-number", self.notification_serial_number)
-        doc.appendChild(ack)
-        # return full acknowledgment
         self.response.headers['Content-Type'] = 'text/xml'
-        self.response.out.write( doc.toxml(encoding="utf-8") )
+        self.response.out.write( acknowledgment_xml(self.notification_serial_number) )
 
     def _check_request(self):
         "Check to ensure valid Google notification."
-        if not self.request.headers.get('Authorization'):
+        self.merchant_account = None
+        auth_string = self.request.headers.get('Authorization')
+        if not auth_string:
             logging.error("GoogleNotification: incoming notification had no Authorization header")
+            self.outcome = 'unauthorized'
             return self.error(401)            
-        #get the Authorization string from the Google POST header         
-        auth_string = self.request.headers.get('Authorization')       
-        #decode the Authorization string and remove Basic portion
-        plain_string = base64.b64decode(auth_string.lstrip('Basic '))
-        #split the decoded string at the ':'
-        merchant_id, merchant_key = plain_string.split(':')
         # check credentials
-        our_merchant_id,our_merchant_key = self.merchant_details()
-        if merchant_id != our_merchant_id or merchant_key != our_merchant_key:
+        self.merchant_account = self._credentials().verify(auth_string)
+        if self.merchant_account is None:
             logging.error("GoogleNotification: incoming notification had unexpected merchant id and/or key")
+            self.outcome = 'unauthorized'
             return self.error(401)
         # check body exits
         if not self.request.body:
             logging.error("GoogleNotification: incoming notification had no request body")
+            self.outcome = 'bad_request'
             return self.error(400)
         # everything looks ok
         return True
 
+    @property
+    def order_state(self):
+        "the OrderState of the current order from order_states (or None)"
+        if self.order_states is None:
+            return None
+        return self.order_states.get(self.raw_notification.google_order_number)
+
+    @property
+    def remote_order(self):
+        "the RemoteOrder for the current notification, created on first use"
+        try:
+            return self._remote_order_instance
+        except AttributeError:
+            if self.metrics is None:
+                self._remote_order_instance = self._remote_order()
+            else:
+                started = time.time()
+                self._remote_order_instance = self._remote_order()
+                self.metrics.observe('notification_stage_seconds', time.time() - started,
+                    {'type': self.notification_type, 'stage': 'remote_order'})
+            return self._remote_order_instance
+
     def _remote_order(self):
         """
         returns an instance of the googlecheckout.Client Order for the
@@ -253,13 +1281,16 @@ class NotificationHandler(webapp.RequestHandler):
                     elif int(self.notification.order_total) > 3000:
                         self.remote_order.cancel()
         """
-        mid,mkey = self.merchant_details()
+        mid,mkey = self._merchant_details()
         try:
-            cur = self.notification.order_summary.order_total_currency
+            cur = self.raw_notification.order_summary.order_total_currency
         except AttributeError:
             cur = None
         RemoteOrder = Client(mid, mkey, currency=cur if cur else "USD")
-        return RemoteOrder(self.notification.google_order_number)
+        order = RemoteOrder(self.raw_notification.google_order_number)
+        if self.metrics is not None:
+            order.metrics = self.metrics
+        return order
 
     def new_order(self):
         self.unhandled_notification()
@@ -284,46 +1315,666 @@ class NotificationHandler(webapp.RequestHandler):
 
     def unhandled_notification(self):
         raise IgnoreNotification("GoogleNotification: %s received but ignored" %  self.notification_type)
+
+    @classmethod
+    def _dispatch_table(cls):
+        """returns a dict of notification type to the tuple of functions that 
+        handle it, built once per class from notification_methods (where the
+        method is overridden) and the methods registered with @handles. a 
+        registration is inherited by methods overriding it (re-decorate to
+        change the types) and registered methods are called in the order 
+        they are defined, base classes first"""
+        if '_dispatch_funcs' not in cls.__dict__:
+            table = {}
+            for notification_type, name in cls.notification_methods.items():
+                func = getattr(cls, name).im_func
+                base = getattr(NotificationHandler, name, None)
+                if base is None or func is not base.im_func:
+                    table.setdefault(notification_type, []).append(func)
+            registered = OrderedDict()
+            for klass in reversed(cls.__mro__):
+                funcs = [(name, func) for name, func in vars(klass).items()
+                    if hasattr(func, '_notification_types') and hasattr(func, 'func_code')]
+                funcs.sort(key=lambda (name, func): func.func_code.co_firstlineno)
+                for name, func in funcs:
+                    registered[name] = func._notification_types
+            for name, notification_types in registered.items():
+                func = getattr(getattr(cls, name, None), 'im_func', None)
+                if func is None:
+                    continue
+                for notification_type in notification_types:
+                    if func not in table.setdefault(notification_type, []):
+                        table[notification_type].append(func)
+            cls._dispatch_funcs = dict((t, tuple(funcs)) for t, funcs in table.items())
+        return cls._dispatch_funcs
+
+    @classmethod
+    def _handled_notification_types(cls):
+        """returns the set of notification types that this class has handlers
+        for, or None if every notification has to be processed"""
+        if '_handled_types' not in cls.__dict__:
+            def overridden(name):
+                return getattr(cls, name).im_func is not getattr(NotificationHandler, name).im_func
+            if overridden('unhandled_notification') or overridden('_process_notification'):
+                cls._handled_types = None
+            else:
+                cls._handled_types = frozenset(cls._dispatch_table())
+        return cls._handled_types
+
+    def _acknowledge_unhandled(self):
+        """acknowledge notifications that would only be ignored straight away
+        without parsing the body. returns True if the notification was acked"""
+        handled = self._handled_notification_types()
+        if handled is None or self.notification_type in handled:
+            return False
+        # order_states needs to see every notification that changes an order
+        if self.order_states is not None and self.notification_type in self.order_states.projections:
+            return False
+        logging.info("GoogleNotification: %s received but ignored" % self.notification_type)
+        self.outcome = 'ignored'
+        self._handshake()
+        return True
+
+    def _already_processed(self):
+        "True if serial_store says the notification was processed already"
+        if self.serial_store is None or self.notification_serial_number is None:
+            return False
+        if self.serial_store.get(self.notification_serial_number) != SerialStore.DONE:
+            return False
+        logging.info("GoogleNotification: %s %s already processed" % (
+            self.notification_type, self.notification_serial_number))
+        self.outcome = 'duplicate'
+        return True
+
+    def _acknowledge_processed(self):
+        """acknowledge notifications that serial_store says were already 
+        processed. returns True if the notification was acked"""
+        if not self._already_processed():
+            return False
+        self._handshake()
+        return True
+
+    def _record_serial(self, status):
+        if self.serial_store is not None:
+            self.serial_store.set(self.notification_serial_number, status)
             
     def _process_notification(self):
-        "call the apropriate method for each notification type"
-        if self.notification_type == 'new-order-notification': #new order
-            self.new_order()
-        elif self.notification_type == 'risk-information-notification':
-            self.risk_information()
-        elif self.notification_type == 'order-state-change-notification':
-            self.order_state_change()
-        elif self.notification_type == 'charge-amount-notification':
-            self.charge_amount()
-        elif self.notification_type == 'authorization-amount-notification':
-            self.authorization_amount()
-        elif self.notification_type == 'refund-amount-notification':
-            self.refund_amount()
-        elif self.notification_type == 'chargeback-amount-notification':
-            self.chargeback_amount()
-        else: #all other notifications are ignored    
-            self.unhandled_notification()
+        "call the apropriate method(s) for each notification type"
+        funcs = self._dispatch_table().get(self.notification_type)
+        if not funcs: #all other notifications are ignored
+            return self.unhandled_notification()
+        for func in funcs:
+            func(self)
             
     def post(self): 
+        self.outcome = None
+        if self.metrics is None:
+            return self._post()
+        # time each stage and record the outcome
+        self.notification_type = 'unknown'
+        started = self._last_mark = time.time()
+        try:
+            try:
+                self._post()
+            except:
+                self.outcome = 'error'
+                raise
+        finally:
+            self._record_request(time.time() - started)
+
+    def _post(self):
         if not self._check_request():
             logging.error("GoogleNotification: invalid")
             return
-        # parse/init notification request
-        self._parse_notification()
-        # try to call process notification method
+        self._mark('auth')
+        # look at the type and serial number before doing any real work
+        self.notification_type, self.notification_serial_number = peek_notification(self.request.body)
+        self._mark('peek')
+        if self.notification_serial_number is not None:
+            # ack redelivered notifications and anything we would ignore anyway
+            if self._acknowledge_processed() or self._acknowledge_unhandled():
+                self._mark('handshake')
+                return
+            # or queue it to be processed after it has been acknowledged
+            if self.work_queue is not None:
+                if self.work_queue.put(self.request.body, self.merchant_account[0], self.notification_serial_number):
+                    self.outcome = 'queued'
+                else:
+                    self.outcome = 'duplicate'
+                self._handshake()
+                self._mark('handshake')
+                return
+        self._dispatch(self.request.body)
+        self._handshake()
+        self._mark('handshake')
+
+    def _mark(self, stage):
+        "record the time spent in stage since the last mark (if metrics are enabled)"
+        if self.metrics is not None:
+            now = time.time()
+            self.metrics.observe('notification_stage_seconds', now - self.__dict__.get('_last_mark', now),
+                {'type': self.notification_type, 'stage': stage})
+            self._last_mark = now
+
+    def _record_request(self, elapsed):
+        labels = {'type': self.notification_type, 'outcome': self.outcome}
+        self.metrics.increment('notifications_total', labels)
+        self.metrics.observe('notification_seconds', elapsed, labels)
+        if self.outcome in ('unauthorized', 'bad_request'):
+            return
+        body = self.request.body
+        self.metrics.observe('notification_body_bytes', len(body), {'type': self.notification_type})
+        if self.notification_type == 'new-order-notification' and 'raw_notification' in self.__dict__:
+            try:
+                items = len(self.raw_notification.shopping_cart.items)
+            except (AttributeError, KeyError):
+                items = 0
+            self.metrics.observe('notification_cart_items', items, {'type': self.notification_type})
+
+    def replay(self, body, merchant_id=None):
+        """parse and process a notification body without the HTTP layer (no
+        auth check and no acknowledgement). merchant_id is the account the 
+        notification was sent to (see merchant_accounts). Notifications that
+        serial_store says were processed already are skipped. Exceptions 
+        other than IgnoreNotification are raised"""
+        self.outcome = None
+        self.merchant_account = self._credentials().account(merchant_id) if merchant_id is not None else None
+        self.notification_type, self.notification_serial_number = peek_notification(body)
+        if self._already_processed():
+            return
+        self._dispatch(body)
+
+    def _dispatch(self, body):
+        "run the middleware and then parse and process body"
+        if not self.middleware:
+            return self._process_body(body)
+        def call(i):
+            if i == len(self.middleware):
+                return self._process_body(body)
+            return self.middleware[i](self, lambda: call(i + 1))
         try:
-            self._process_notification()
+            call(0)
         except IgnoreNotification, e:
-            # if IgnoreNotification is raised, the handshake will be completed
-            # so google will not retry the notifcation in the future. all handler
-            # methods raise this by default
+            # middleware can ignore notifications the same way handlers do
             logging.info(str(e))
-        self._handshake()
+            self.outcome = 'ignored'
+        if self.outcome is None:
+            self.outcome = 'skipped'
+
+    def _process_body(self, body):
+        # parse/init notification request
+        self._parse_notification(body)
+        self._mark('parse')
+        # try to call process notification method
+        try:
+            if self.order_states is not None:
+                self.order_states.apply(self.notification_type, self.raw_notification, self.notification_serial_number)
+            try:
+                self._process_notification()
+                self.outcome = 'handled'
+            except IgnoreNotification, e:
+                # if IgnoreNotification is raised, the handshake will be completed
+                # so google will not retry the notifcation in the future. all handler
+                # methods raise this by default
+                logging.info(str(e))
+                self.outcome = 'ignored'
+            finally:
+                self._mark('handler')
+        except:
+            # google will resend it, so let it be processed again
+            self._record_serial(SerialStore.FAILED)
+            raise
+        self._record_serial(SerialStore.DONE)
     
 
 
+class NotificationQueue(object):
+    """A durable (sqlite) queue of raw notification bodies for processing
+    notifications after they have been acknowledged.
+
+    Failed notifications are retried after an exponential backoff (with 
+    jitter) of backoff, 2*backoff, 4*backoff ... seconds up to max_backoff.
+    After max_attempts failures they are moved to the dead-letter queue
+    (see dead_letters and retry_dead)"""
+
+    QUEUED = 'queued'
+    WORKING = 'working'
+    DEAD = 'dead'
+
+    def __init__(self, path, max_attempts=5, backoff=30, max_backoff=60*60):
+        if sqlite3 is None:
+            raise Error("NotificationQueue requires the sqlite3 module")
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS notifications "
+            "(id INTEGER PRIMARY KEY AUTOINCREMENT, body BLOB, state TEXT, "
+            "attempts INTEGER, next_attempt REAL, last_error TEXT, merchant_id TEXT, serial_number TEXT)")
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(notifications)")]
+        for column in ('merchant_id', 'serial_number'):
+            if column not in columns:
+                self._db.execute("ALTER TABLE notifications ADD COLUMN %s TEXT" % column)
+        # anything still marked as working was interrupted
+        self._db.execute("UPDATE notifications SET state = ? WHERE state = ?", (self.QUEUED, self.WORKING))
+        self._db.commit()
+
+    def _execute(self, sql, args=()):
+        self._lock.acquire()
+        try:
+            rows = self._db.execute(sql, args).fetchall()
+            self._db.commit()
+            return rows
+        finally:
+            self._lock.release()
+
+    def put(self, body, merchant_id=None, serial_number=None):
+        """store a notification body and the merchant id it was sent to. 
+        returns False (and stores nothing) if a notification with the same
+        serial_number is already waiting"""
+        self._lock.acquire()
+        try:
+            if serial_number is not None and self._db.execute("SELECT id FROM notifications "
+                    "WHERE serial_number = ? AND state != ?", (serial_number, self.DEAD)).fetchone():
+                return False
+            self._db.execute("INSERT INTO notifications (body, state, attempts, next_attempt, merchant_id, serial_number) "
+                "VALUES (?, ?, 0, 0, ?, ?)", (sqlite3.Binary(body), self.QUEUED, merchant_id, serial_number))
+            self._db.commit()
+            return True
+        finally:
+            self._lock.release()
+
+    def claim(self):
+        "returns a tuple of (id, body, merchant_id) for the next notification due or None"
+        self._lock.acquire()
+        try:
+            row = self._db.execute("SELECT id, body, merchant_id FROM notifications WHERE state = ? AND next_attempt <= ? "
+                "ORDER BY id LIMIT 1", (self.QUEUED, time.time())).fetchone()
+            if row is None:
+                return None
+            self._db.execute("UPDATE notifications SET state = ? WHERE id = ?", (self.WORKING, row[0]))
+            self._db.commit()
+            return row[0], str(row[1]), row[2]
+        finally:
+            self._lock.release()
+
+    def done(self, id):
+        "remove a successfully processed notification"
+        self._execute("DELETE FROM notifications WHERE id = ?", (id,))
+
+    def failed(self, id, error=None):
+        "schedule a retry for a notification or move it to the dead-letter queue"
+        self._lock.acquire()
+        try:
+            attempts = self._db.execute("SELECT attempts FROM notifications WHERE id = ?", (id,)).fetchone()[0] + 1
+            if attempts >= self.max_attempts:
+                state, delay = self.DEAD, 0
+            else:
+                state = self.QUEUED
+                delay = min(self.max_backoff, self.backoff * 2 ** (attempts - 1)) * random.uniform(0.5, 1)
+            self._db.execute("UPDATE notifications SET state = ?, attempts = ?, next_attempt = ?, last_error = ? "
+                "WHERE id = ?", (state, attempts, time.time() + delay, error, id))
+            self._db.commit()
+        finally:
+            self._lock.release()
+
+    def dead_letters(self):
+        "returns a list of (id, body, attempts, last_error) for dead notifications"
+        return [(id, str(body), attempts, error) for id, body, attempts, error in 
+            self._execute("SELECT id, body, attempts, last_error FROM notifications WHERE state = ? ORDER BY id", (self.DEAD,))]
+
+    def retry_dead(self, id=None):
+        "requeue one (or all) dead notifications"
+        if id is None:
+            self._execute("UPDATE notifications SET state = ?, attempts = 0, next_attempt = 0 WHERE state = ?", 
+                (self.QUEUED, self.DEAD))
+        else:
+            self._execute("UPDATE notifications SET state = ?, attempts = 0, next_attempt = 0 WHERE id = ? AND state = ?", 
+                (self.QUEUED, id, self.DEAD))
+
+    def __len__(self):
+        "the number of notifications waiting (not dead)"
+        return self._execute("SELECT COUNT(*) FROM notifications WHERE state != ?", (self.DEAD,))[0][0]
+
+class NotificationWorker(object):
+    """
+    Processes the notifications stored in a NotificationQueue with a pool of
+    threads, calling the same handler methods as NotificationHandler.post:
+
+        class MyNotificationHandler(NotificationHandler):
+            work_queue = googlecheckout.NotificationQueue('/var/lib/checkout/queue.db')
+            ...
+
+        worker = googlecheckout.NotificationWorker(MyNotificationHandler, threads=4)
+        worker.start()
+    """
+    def __init__(self, handler_class, queue=None, threads=2, poll_interval=1.0):
+        self.handler_class = handler_class
+        self.queue = queue if queue is not None else handler_class.work_queue
+        self.threads = threads
+        self.poll_interval = poll_interval
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def process_one(self):
+        "process the next notification due. returns False if there was none"
+        item = self.queue.claim()
+        if item is None:
+            return False
+        id, body, merchant_id = item
+        try:
+            self.handler_class().replay(body, merchant_id)
+        except Exception, e:
+            logging.exception("GoogleNotification: queued notification %s failed" % id)
+            self.queue.failed(id, repr(e))
+        else:
+            self.queue.done(id)
+        return True
+
+    def run_pending(self):
+        "process every notification that is due in the current thread"
+        while self.process_one():
+            pass
+
+    def _run(self):
+        while not self._stopping.is_set():
+            if not self.process_one():
+                self._stopping.wait(self.poll_interval)
+
+    def start(self):
+        self._stopping.clear()
+        for i in range(self.threads):
+            t = threading.Thread(target=self._run)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, wait=True):
+        self._stopping.set()
+        if wait:
+            for t in self._threads:
+                t.join()
+        self._threads = []
+
+
 # order processing api: 
 
+# Order classes returned by Client keyed by their configuration
+_order_classes = {}
+
+def _text_element(tag, text, currency=None):
+    "serialize a simple text element (with an optional currency attribute)"
+    if currency is None:
+        return u"<%s>%s</%s>" % (tag, _xml_escape(text), tag)
+    return u'<%s currency="%s">%s</%s>' % (tag, _xml_escape(currency), _xml_escape(text), tag)
+
+def command_xml(tag, order_number, body=u""):
+    """returns the (utf-8) XML for an order processing command. body is the
+    already serialized content of the command element. The output is the 
+    same as building the document with minidom and calling toxml("utf-8")"""
+    xml = u'<?xml version="1.0" encoding="utf-8"?><%s google-order-number="%s" xmlns="http://checkout.google.com/schema/2"' % (
+        tag, _xml_escape(order_number))
+    if body:
+        xml += u">%s</%s>" % (body, tag)
+    else:
+        xml += u"/>"
+    return xml.encode("utf-8")
+
+class NoResponseError(Error):
+    """raised by ConnectionPool.request when the request was sent but reading
+    the response failed (reason is the original error). the server may 
+    have acted on the request"""
+    def __init__(self, reason):
+        Error.__init__(self, "%s: %s" % (reason.__class__.__name__, reason))
+        self.reason = reason
+
+def _closed_while_idle(e):
+    """true if e shows a reused connection had been closed by the server: 
+    sending failed with a reset or broken pipe, or the server closed the 
+    connection without sending anything back (an empty status line)"""
+    if isinstance(e, httplib.BadStatusLine):
+        # nothing at all was read (newer pythons say so in the message)
+        return e.line in ('', "''") or e.line.startswith("No status line received")
+    if isinstance(e, socket.timeout):
+        return False
+    return bool(e.args) and e.args[0] in (errno.ECONNRESET, errno.EPIPE)
+
+class ConnectionPool(object):
+    """A thread-safe, bounded pool of persistent HTTPS connections to one host.
+
+    At most maxsize connections are open at once (get blocks until one is
+    returned). Connections left idle for longer than idle_timeout seconds
+    are closed rather than reused, and a request on a reused connection 
+    that turns out to be stale is retried once on a fresh connection. Only 
+    failures that show the server closed the connection before reading the 
+    request are retried (commands such as charge are not idempotent): an 
+    error while sending it, or no response at all. Any other error once the
+    request has been sent, such as a timeout or a reset, is raised as a
+    NoResponseError"""
+
+    def __init__(self, host, maxsize=4, idle_timeout=60, timeout=None):
+        self.host = host
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxsize)
+
+    def _connect(self):
+        if self.timeout is None:
+            return httplib.HTTPSConnection(self.host)
+        return httplib.HTTPSConnection(self.host, timeout=self.timeout)
+
+    def get(self):
+        "returns a tuple of (connection, reused)"
+        self._slots.acquire()
+        now = time.time()
+        self._lock.acquire()
+        try:
+            while self._idle:
+                conn, last_used = self._idle.pop()
+                if now - last_used <= self.idle_timeout:
+                    self.hits += 1
+                    return conn, True
+                conn.close()
+                self.stale += 1
+            self.misses += 1
+        finally:
+            self._lock.release()
+        return self._connect(), False
+
+    def put(self, conn, reusable=True):
+        "return a connection from get() to the pool"
+        if reusable:
+            self._lock.acquire()
+            try:
+                self._idle.append((conn, time.time()))
+            finally:
+                self._lock.release()
+        else:
+            conn.close()
+        self._slots.release()
+
+    def request(self, method, url, body=None, headers={}):
+        "make a request returning a tuple of (status, body)"
+        conn, reused = self.get()
+        try:
+            try:
+                conn.request(method, url, body, headers)
+            except socket.error, e:
+                if not reused or not _closed_while_idle(e):
+                    raise
+                conn = self._reconnect(conn)
+                conn.request(method, url, body, headers)
+                response, data = self._read(conn)
+            else:
+                try:
+                    response, data = self._read(conn)
+                except NoResponseError, e:
+                    if not reused or not isinstance(e.reason, httplib.BadStatusLine) or not _closed_while_idle(e.reason):
+                        raise
+                    conn = self._reconnect(conn)
+                    conn.request(method, url, body, headers)
+                    response, data = self._read(conn)
+        except:
+            self.put(conn, reusable=False)
+            raise
+        self.put(conn, reusable=not response.will_close)
+        return response.status, data
+
+    def _read(self, conn):
+        "returns the response and body for the request sent on conn"
+        try:
+            response = conn.getresponse()
+            return response, response.read()
+        except (socket.error, httplib.HTTPException), e:
+            raise NoResponseError(e)
+
+    def _reconnect(self, conn):
+        "replace a connection the server closed while it was idle"
+        conn.close()
+        self._lock.acquire()
+        self.stale += 1
+        self._lock.release()
+        return self._connect()
+
+    def stats(self):
+        "returns a dict of pool counters"
+        return {'host': self.host, 'hits': self.hits, 'misses': self.misses, 
+                'stale': self.stale, 'idle': len(self._idle)}
+
+# one ConnectionPool per host
+_pools = {}
+_pools_lock = threading.Lock()
+
+def connection_pool(host):
+    "returns the shared ConnectionPool for host"
+    _pools_lock.acquire()
+    try:
+        if host not in _pools:
+            _pools[host] = ConnectionPool(host)
+        return _pools[host]
+    finally:
+        _pools_lock.release()
+
+class RetryPolicy(object):
+    """How often and how long to wait before resending an Order Processing
+    command that failed with a RetryableOrderError. The wait before retry n
+    is a random time up to min(max_backoff, backoff * 2**(n-1)) seconds"""
+    def __init__(self, max_attempts=3, backoff=0.5, max_backoff=10):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def delay(self, attempt):
+        "seconds to wait after the attempt'th failed attempt"
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+class CircuitBreaker(object):
+    """Fails fast once failure_threshold consecutive requests to a host have
+    failed with retryable errors. After reset_timeout seconds a single trial
+    request is let through and closes the circuit again if it succeeds"""
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened is None:
+            return 'closed'
+        if time.time() - self.opened >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        "returns True if a request may be sent"
+        self._lock.acquire()
+        try:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self._trial:
+                self._trial = True
+                return True
+            return False
+        finally:
+            self._lock.release()
+
+    def success(self):
+        self._lock.acquire()
+        try:
+            self.failures = 0
+            self.opened = None
+            self._trial = False
+        finally:
+            self._lock.release()
+
+    def failure(self):
+        self._lock.acquire()
+        try:
+            self.failures += 1
+            if self._trial or self.failures >= self.failure_threshold:
+                self.opened = time.time()
+            self._trial = False
+        finally:
+            self._lock.release()
+
+    def release(self):
+        "end a trial request without an outcome (it failed for an unrelated reason)"
+        self._lock.acquire()
+        try:
+            self._trial = False
+        finally:
+            self._lock.release()
+
+# one CircuitBreaker per host
+_breakers = {}
+
+def circuit_breaker(host):
+    "returns the shared CircuitBreaker for host"
+    _pools_lock.acquire()
+    try:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker()
+        return _breakers[host]
+    finally:
+        _pools_lock.release()
+
+class TokenBucket(object):
+    """A client side rate limiter allowing rate requests per second on 
+    average and bursts of up to burst requests. acquire blocks until a 
+    request is allowed"""
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst if burst is not None else max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            self._lock.acquire()
+            try:
+                now = time.time()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            finally:
+                self._lock.release()
+            time.sleep(wait)
+
 def Client(merchant_id, merchant_key, sandbox=False, currency="USD"):
     """
     googlecheckout.Client returns a class for interacting with google
@@ -344,9 +1995,32 @@ def Client(merchant_id, merchant_key, sandbox=False, currency="USD"):
         # charge and ship it
         order.charge_and_ship()
 
+    the classes are cached, so calling Client again with the same arguments 
+    returns the same class. Failed commands raise a RetryableOrderError or 
+    a FatalOrderError, or an OrderOutcomeUnknownError (which is never
+    retried) when the command was sent but no response arrived. To retry
+    failed commands, to fail fast with a 
+    CircuitOpenError while google checkout appears to be down and to limit
+    the request rate of all the orders of a class set:
+
+        CheckoutOrder.retry_policy = googlecheckout.RetryPolicy(max_attempts=4)
+        CheckoutOrder.circuit_breaker = googlecheckout.circuit_breaker("checkout.google.com")
+        CheckoutOrder.rate_limiter = googlecheckout.TokenBucket(rate=10, burst=20)
     """
-    
+    key = (merchant_id, merchant_key, sandbox, currency)
+    if key in _order_classes:
+        return _order_classes[key]
+
     class Order(object):
+        # a Metrics sink for request latency by command and status
+        metrics = None
+        # a RetryPolicy for commands that fail with a RetryableOrderError
+        retry_policy = None
+        # a CircuitBreaker (eg. the shared circuit_breaker(host))
+        circuit_breaker = None
+        # a TokenBucket shared by all orders of this class
+        rate_limiter = None
+
         def __init__(self, order_number):
             self.merchant_id = merchant_id
             self.merchant_key = merchant_key
@@ -359,34 +2033,84 @@ def Client(merchant_id, merchant_key, sandbox=False, currency="USD"):
                 "Accept": "application/xml; charset=UTF-8",
                 "Authorization": self._authorization()}
             if sandbox:
-                conn = httplib.HTTPSConnection("sandbox.google.com")
-                conn.request("POST", "/checkout/api/checkout/v2/request/Merchant/"+self.merchant_id, xml, headers)
+                host = "sandbox.google.com"
+                url = "/checkout/api/checkout/v2/request/Merchant/"+self.merchant_id
             else:
-                conn = httplib.HTTPSConnection("checkout.google.com")
-                conn.request("POST", "/api/checkout/v2/request/Merchant/"+self.merchant_id, xml, headers)
-            response = conn.getresponse()
-            body = response.read()
-            doc = parseString(body).documentElement
-            # handle error responses by raising them as exceptions
-            if response.status != 200:
-                errs = doc.getElementsByTagName("error-message")
-                errmsg = ""
-                for e in errs:
-                    errmsg += e.firstChild.data.encode("ascii", "ignore") + " "
-                raise Exception("google checkout: " + errmsg)
-            return doc
+                host = "checkout.google.com"
+                url = "/api/checkout/v2/request/Merchant/"+self.merchant_id
+            # connections are kept alive and reused between requests
+            pool = connection_pool(host)
+            breaker = self.circuit_breaker
+            attempt = 0
+            while True:
+                attempt += 1
+                if self.rate_limiter is not None:
+                    self.rate_limiter.acquire()
+                if breaker is not None and not breaker.allow():
+                    raise CircuitOpenError("google checkout: %s is unavailable" % host)
+                try:
+                    try:
+                        if self.metrics is None:
+                            status, body = pool.request("POST", url, xml, headers)
+                        else:
+                            status, body = self._timed_request(pool, url, xml, headers)
+                    except NoResponseError, e:
+                        error = OrderOutcomeUnknownError("google checkout: no response from %s (%s)" % (host, e))
+                    except (socket.error, httplib.HTTPException), e:
+                        # the request was not sent
+                        error = RetryableOrderError("google checkout: %s" % (e or e.__class__.__name__))
+                    else:
+                        # the body of a successful response is not needed so it is not parsed
+                        error = self._error(status, body) if status != 200 else None
+                except:
+                    # not an outcome of the request, so it does not count as a failure
+                    if breaker is not None:
+                        breaker.release()
+                    raise
+                retryable = isinstance(error, RetryableOrderError)
+                if breaker is not None:
+                    if retryable or isinstance(error, OrderOutcomeUnknownError):
+                        breaker.failure()
+                    else:
+                        breaker.success()
+                if error is None:
+                    return body
+                # handle error responses by raising them as exceptions
+                if not retryable:
+                    raise error
+                if self.retry_policy is None or attempt >= self.retry_policy.max_attempts:
+                    raise error
+                time.sleep(self.retry_policy.delay(attempt))
+
+        def _error(self, status, body):
+            "returns the OrderProcessingError for an error response"
+            try:
+                doc = parseString(body).documentElement
+                errs = [e.firstChild.data for e in doc.getElementsByTagName("error-message") if e.firstChild]
+            except expat.ExpatError:
+                errs = []
+            errmsg = ""
+            for e in errs:
+                errmsg += e.encode("ascii", "ignore") + " "
+            if status >= 500 or status == 429:
+                return RetryableOrderError("google checkout: " + errmsg, status, errs)
+            return FatalOrderError("google checkout: " + errmsg, status, errs)
     
+        def _timed_request(self, pool, url, xml, headers):
+            # the command is the root element name
+            labels = {'command': xml.split("<", 2)[2].split(" ", 1)[0], 'status': 'error'}
+            started = time.time()
+            try:
+                status, body = pool.request("POST", url, xml, headers)
+                labels['status'] = status
+                return status, body
+            finally:
+                self.metrics.increment('order_requests_total', labels)
+                self.metrics.observe('order_request_seconds', time.time() - started, labels)
+
         def _authorization(self):
             return "Basic " + base64.b64encode(self.merchant_id + ":" + self.merchant_key)
         
-        def _doc(self, tag):
-            doc = getDOMImplementation().createDocument(None, tag, None)
-            # set ns
-            doc.documentElement.setAttribute("xmlns", "http://checkout.google.com/schema/2")
-            # set order id
-            doc.documentElement.setAttribute("google-order-number", self.order_number)
-            return doc
-
         def authorize(self):
             """
             instructs Google Checkout to explicitly reauthorize a customer's 
@@ -396,9 +2120,8 @@ def Client(merchant_id, merchant_key, sandbox=False, currency="USD"):
             reauthorize an order that had been partially charged.)
             """
             # WARNING: you may be charged $0.30 for this call 
-            doc = self._doc("authorize-order")
             # send xml msg to google checkout
-            self._request( doc.toxml("utf-8") )
+            self._request( command_xml("authorize-order", self.order_number) )
             
         def cancel(self, reason="no reason given", comment=""):
             """
@@ -407,42 +2130,30 @@ def Client(merchant_id, merchant_key, sandbox=False, currency="USD"):
             can cancel the order. You may only issue a "cancel" command for an order that 
             is in either CHARGEABLE or PAYMENT_DECLINED state
             """
-            doc = self._doc("cancel-order")
             # set reason
-            el = doc.createElement("reason")
-            el.appendChild( doc.createTextNode(str(reason)) )
-            doc.documentElement.appendChild(el)
+            body = _text_element("reason", str(reason))
             # set comment
             if comment:
-                el = doc.createElement("comment")
-                el.appendChild( doc.createTextNode(str(comment)) )
-                doc.documentElement.appendChild(el)
+                body += _text_element("comment", str(comment))
             # send xml msg to google checkout
-            self._request( doc.toxml("utf-8") )
+            self._request( command_xml("cancel-order", self.order_number, body) )
             
         def refund(self, reason, amount=None, comment=""):
             """
             instructs Google Checkout to refund the buyer for a particular order. 
             You may issue a "refund" for orders in CHARGED state.
             """
-            doc = self._doc("refund-order")
+            body = u""
             # set amount to refund
             if amount is not None:
-                el = doc.createElement("amount")
-                el.setAttribute("currency", self.currency)
-                el.appendChild( doc.createTextNode(str(amount)) )
-                doc.documentElement.appendChild(el)
+                body += _text_element("amount", str(amount), self.currency)
             # set reason
-            el = doc.createElement("reason")
-            el.appendChild( doc.createTextNode(str(reason)) )
-            doc.documentElement.appendChild(el)
+            body += _text_element("reason", str(reason))
             # set comment
             if comment:
-                el = doc.createElement("comment")
-                el.appendChild( doc.createTextNode(str(comment)) )
-                doc.documentElement.appendChild(el)
+                body += _text_element("comment", str(comment))
             # send xml msg to google checkout
-            self._request( doc.toxml("utf-8") )
+            self._request( command_xml("refund-order", self.order_number, body) )
             
         def charge_and_ship(self, amount=None, carrier=None, carrier_id=None):
             """
@@ -453,33 +2164,353 @@ def Client(merchant_id, merchant_key, sandbox=False, currency="USD"):
             that are in CHARGEABLE or CHARGED (if the order has only been partially charged)
             states
             """
-            doc = self._doc("charge-and-ship-order")
+            body = u""
             # set amount to charge (or leave blank for full)
             if amount is not None:
-                el = doc.createElement("amount")
-                el.setAttribute("currency", self.currency)
-                el.appendChild( doc.createTextNode(str(amount)) )
-                doc.documentElement.appendChild(el)
+                body += _text_element("amount", str(amount), self.currency)
             # set tracking data (if given) 
             if carrier is not None or carrier_id is not None:
-                tel = doc.createElement("tracking-data")
+                tracking = u""
                 # set carrier (if given)
                 if carrier is not None:
-                    cel = doc.createElement("carrier")
-                    cel.appendChild( doc.createTextNode(carrier) )
-                    tel.appendChild(cel)
+                    tracking += _text_element("carrier", carrier)
                 # set tracking id if given along with carrier
                 if carrier_id is not None:
-                    nel = doc.createElement("tracking-number")
-                    nel.appendChild( doc.createTextNode(carrier_id) )
-                    tel.appendChild(nel)
+                    tracking += _text_element("tracking-number", carrier_id)
                 # add item to list
-                el = doc.createElement("tracking-data-list")
-                el.appendChild(tel)
-                doc.documentElement.appendChild(el)
+                body += u"<tracking-data-list><tracking-data>%s</tracking-data></tracking-data-list>" % tracking
             # send xml msg to google checkout
-            self._request( doc.toxml("utf-8") )
+            self._request( command_xml("charge-and-ship-order", self.order_number, body) )
             
-    return Order
+    return _order_classes.setdefault(key, Order)
+
+
+
+
+class OrderResult(object):
+    "The outcome of a single OrderDispatcher job"
+    def __init__(self, order_number, command, result=None, error=None):
+        self.order_number = order_number
+        self.command = command
+        self.result = result
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def messages(self):
+        "the google checkout error messages (if any)"
+        return getattr(self.error, 'messages', [])
+
+    def __repr__(self):
+        return "<OrderResult %s %s %s>" % (self.order_number, self.command, 
+            "ok" if self.ok else repr(self.error))
+
+class OrderDispatcher(object):
+    """
+    Runs Order Processing commands for many orders concurrently using the 
+    Order class returned by googlecheckout.Client:
+
+        CheckoutOrder = googlecheckout.Client(merchant_id, merchant_key)
+        dispatcher = googlecheckout.OrderDispatcher(CheckoutOrder, concurrency=8)
+        results = dispatcher.run([
+            ('859558483052501', 'charge_and_ship', {'carrier': 'FEDEX', 'carrier_id': '123'}),
+            ('859558483052502', 'refund', ("it's all squishy",)),
+            ('859558483052503', 'cancel'),
+        ])
+        for result in results:
+            if not result.ok:
+                logging.error("%s failed: %s", result.order_number, result.messages)
+
+    Each job is a tuple of (order_number, command[, args]) where command is 
+    the name of an Order method and args is a tuple of positional arguments
+    or a dict of keyword arguments. run() blocks until all jobs are done and 
+    returns an OrderResult for each job in the same order.
+
+    If concurrent.futures is available, submit() returns a Future for a 
+    single command instead.
+    """
+    commands = ('authorize', 'cancel', 'refund', 'charge_and_ship')
+
+    def __init__(self, order_class, concurrency=4):
+        self.order_class = order_class
+        self.concurrency = concurrency
+        self._executor = None
+
+    def _call(self, order_number, command, args=()):
+        if command not in self.commands:
+            raise ValueError("unknown order command %s" % command)
+        method = getattr(self.order_class(order_number), command)
+        if isinstance(args, dict):
+            return method(**args)
+        return method(*args)
+
+    def _run_job(self, job):
+        job = tuple(job) if isinstance(job, (tuple, list)) else (job,)
+        order_number = job[0] if job else None
+        command = job[1] if len(job) > 1 else None
+        try:
+            if len(job) not in (2, 3):
+                raise ValueError("expected a job of (order_number, command[, args]) not %r" % (job,))
+            return OrderResult(order_number, command, result=self._call(*job))
+        except Exception, e:
+            return OrderResult(order_number, command, error=e)
+
+    def run(self, jobs):
+        "run all jobs, at most self.concurrency at a time"
+        jobs = list(jobs)
+        results = [None] * len(jobs)
+        queue = Queue.Queue()
+        for i, job in enumerate(jobs):
+            queue.put(i)
+        def worker():
+            while True:
+                try:
+                    i = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                results[i] = self._run_job(jobs[i])
+        threads = [threading.Thread(target=worker) for i in range(min(self.concurrency, len(jobs)))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def submit(self, order_number, command, args=()):
+        "returns a Future for the OrderResult of a single job"
+        if futures is None:
+            raise Error("OrderDispatcher.submit requires concurrent.futures")
+        if self._executor is None:
+            self._executor = futures.ThreadPoolExecutor(max_workers=self.concurrency)
+        return self._executor.submit(self._run_job, (order_number, command, args))
+
+    def shutdown(self, wait=True):
+        "stop the executor used by submit()"
+        if self._executor is not None:
+            self._executor.shutdown(wait)
+            self._executor = None
+
+
+# serving notifications outside of appengine's webapp
+
+class WSGIRequest(object):
+    "The request attributes NotificationHandler uses, from a WSGI environ"
+    def __init__(self, environ):
+        self.environ = environ
+        self.headers = {}
+        for key, value in environ.items():
+            if key.startswith('HTTP_'):
+                self.headers[key[5:].replace('_', '-').title()] = value
+        if environ.get('CONTENT_TYPE'):
+            self.headers['Content-Type'] = environ['CONTENT_TYPE']
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        self.body = environ['wsgi.input'].read(length) if length > 0 else ''
+
+class WSGIResponse(object):
+    "The response attributes NotificationHandler uses"
+    def __init__(self):
+        self.status = 200
+        self.headers = {'Content-Type': 'text/plain'}
+        self.out = StringIO()
+
+    def set_status(self, code):
+        self.status = code
+
+    def clear(self):
+        self.out.seek(0)
+        self.out.truncate()
+
+    def status_line(self):
+        return "%d %s" % (self.status, httplib.responses.get(self.status, ''))
+
+def wsgi_application(handler_class):
+    """
+    returns a WSGI application serving the notifications for a 
+    NotificationHandler subclass with any WSGI server:
+
+        application = googlecheckout.wsgi_application(MyNotificationHandler)
+
+    exceptions raised by the handler result in a 500 response so google
+    checkout will resend the notification.
+    """
+    def application(environ, start_response):
+        if environ.get('REQUEST_METHOD') != 'POST':
+            start_response("405 Method Not Allowed", [('Allow', 'POST'), ('Content-Type', 'text/plain'), ('Content-Length', '0')])
+            return [""]
+        handler = handler_class()
+        handler.initialize(WSGIRequest(environ), WSGIResponse())
+        try:
+            handler.post()
+        except Exception:
+            logging.exception("GoogleNotification: failed to process notification")
+            handler.response.clear()
+            handler.response.set_status(500)
+        response = handler.response
+        body = response.out.getvalue()
+        headers = [(str(k), str(v)) for k, v in response.headers.items()]
+        headers.append(('Content-Length', str(len(body))))
+        start_response(response.status_line(), headers)
+        return [body]
+    return application
+
+
+# bulk replay of archived notifications
 
+def read_notifications(path):
+    """yields the raw notification bodies stored at path, which can be a 
+    directory (one notification per file, in filename order), a tarball 
+    or a JSONL file where each line is either a JSON string or an object 
+    with a "body" field. JSONL records that can not be read are yielded as
+    UnreadableNotification errors instead"""
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            filename = os.path.join(path, name)
+            if os.path.isfile(filename):
+                f = open(filename, 'rb')
+                try:
+                    yield f.read()
+                finally:
+                    f.close()
+    elif tarfile.is_tarfile(path):
+        tar = tarfile.open(path)
+        try:
+            for member in tar:
+                if member.isfile():
+                    yield tar.extractfile(member).read()
+        finally:
+            tar.close()
+    else:
+        f = open(path, 'rb')
+        try:
+            for number, line in enumerate(f):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                    if isinstance(record, dict):
+                        record = record['body']
+                    if not isinstance(record, basestring):
+                        raise TypeError("not a string")
+                except (ValueError, KeyError, TypeError), e:
+                    yield UnreadableNotification("%s line %d: %s: %s" % (path, number + 1, e.__class__.__name__, e))
+                    continue
+                yield record.encode('utf-8') if isinstance(record, unicode) else record
+        finally:
+            f.close()
+
+class UnreadableNotification(Error):
+    "an archived notification record that could not be read (see read_notifications)"
+
+def _replay_group(args):
+    "replay one order's notifications in order. returns a list of (index, error)"
+    handler_class, group, merchant_id = args
+    results = []
+    for index, body in group:
+        try:
+            handler_class().replay(body, merchant_id)
+            results.append((index, None))
+        except Exception, e:
+            results.append((index, "%s: %s" % (e.__class__.__name__, e)))
+    return results
+
+class ReplaySummary(object):
+    "The outcome of replay_notifications"
+    def __init__(self, total, orders, failures, elapsed):
+        self.total = total
+        self.orders = orders
+        self.failures = failures
+        self.elapsed = elapsed
+
+    @property
+    def rate(self):
+        "notifications per second"
+        return self.total / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        lines = ["replayed %d notifications for %d orders in %.2fs (%.1f/s), %d failed" % (
+            self.total, self.orders, self.elapsed, self.rate, len(self.failures))]
+        for index, error in self.failures:
+            lines.append("  #%d %s" % (index, error))
+        return "\n".join(lines)
+
+def replay_notifications(handler_class, notifications, processes=None, merchant_id=None):
+    """
+    Push archived notification bodies through a NotificationHandler subclass
+    (see NotificationHandler.replay) using a pool of processes. 
+    
+    notifications is an iterable of raw bodies or a path accepted by 
+    read_notifications. Notifications for the same google-order-number are
+    replayed in their original order by a single process while different 
+    orders run in parallel. Returns a ReplaySummary where failures is a list
+    of (index, error) in the original order, including the notifications 
+    that could not be read or parsed at all.
+
+    handler_class must be importable by the worker processes (defined at 
+    module level). Use processes=1 to replay in the current process. When
+    the handler has several merchant_accounts, merchant_id is the account
+    the archived notifications were sent to.
+    """
+    if isinstance(notifications, basestring):
+        notifications = read_notifications(notifications)
+    started = time.time()
+    groups = OrderedDict()
+    total = 0
+    unreadable = []
+    for index, body in enumerate(notifications):
+        total += 1
+        if isinstance(body, UnreadableNotification):
+            unreadable.append((index, "%s: %s" % (body.__class__.__name__, body)))
+            continue
+        try:
+            order_number = peek_order_number(body)
+        except (expat.ExpatError, TypeError), e:
+            unreadable.append((index, "%s: %s" % (e.__class__.__name__, e)))
+            continue
+        groups.setdefault(order_number, []).append((index, body))
+    tasks = [(handler_class, group, merchant_id) for group in groups.values()]
+    if processes == 1:
+        results = map(_replay_group, tasks)
+    else:
+        import multiprocessing
+        processes = processes or multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_replay_group, tasks, chunksize=max(1, len(tasks) // (processes * 4)))
+        finally:
+            pool.close()
+            pool.join()
+    failures = sorted(unreadable + [(index, error) for group in results for index, error in group if error is not None])
+    return ReplaySummary(total, len(groups), failures, time.time() - started)
+
+def main(argv=None):
+    """
+    command line replay of archived notifications:
+
+        python googlecheckout.py replay mymodule:MyNotificationHandler notifications/ -p 8
+    """
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog replay module:HandlerClass PATH [-p PROCESSES] [-m MERCHANT_ID]")
+    parser.add_option("-p", "--processes", type="int", default=None, 
+        help="number of worker processes (default: number of CPUs)")
+    parser.add_option("-m", "--merchant-id", default=None, 
+        help="the merchant account the notifications were sent to")
+    options, args = parser.parse_args(argv)
+    if len(args) != 3 or args[0] != 'replay' or ':' not in args[1]:
+        parser.error("expected: replay module:HandlerClass PATH")
+    module_name, class_name = args[1].split(':', 1)
+    sys.path.insert(0, os.getcwd())
+    handler_class = getattr(__import__(module_name, fromlist=[class_name]), class_name)
+    summary = replay_notifications(handler_class, args[2], processes=options.processes, 
+        merchant_id=options.merchant_id)
+    print summary
+    return 1 if summary.failures else 0
 
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,1250 @@
+import BaseHTTPServer
+import SocketServer
+import base64
+import errno
+import httplib
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from datetime import datetime
+from decimal import Decimal
+from cStringIO import StringIO
+from xml.dom import minidom
+
+import googlecheckout
+from googlecheckout import DotDict, LazyDotDict, node_to_dotdict, parse_notification
+
+NS = 'xmlns="http://checkout.google.com/schema/2"'
+
+ADDRESS = """<contact-name>John Smith</contact-name>
+    <email>johnsmith@example.com</email>
+    <address1>10 Example Road</address1>
+    <city>Sampleville</city>
+    <region>CA</region>
+    <postal-code>94141</postal-code>
+    <country-code>US</country-code>"""
+
+NOTIFICATIONS = {
+    'new-order-notification': """<?xml version="1.0" encoding="UTF-8"?>
+<new-order-notification %(ns)s serial-number="85f54628-538a-44fc-8605-ae62364f6c71">
+  <google-order-number>841171949013218</google-order-number>
+  <buyer-shipping-address>%(address)s</buyer-shipping-address>
+  <buyer-billing-address>%(address)s</buyer-billing-address>
+  <buyer-id>294873009217523</buyer-id>
+  <fulfillment-order-state>NEW</fulfillment-order-state>
+  <financial-order-state>REVIEWING</financial-order-state>
+  <shopping-cart>
+    <cart-expiration><good-until-date>2007-12-31T23:59:59-05:00</good-until-date></cart-expiration>
+    <items>
+      <item>
+        <merchant-item-id>GGLAA1453</merchant-item-id>
+        <item-name>Dry Food Pack</item-name>
+        <item-description>nutrition food pack</item-description>
+        <quantity>1</quantity>
+        <tax-table-selector>food</tax-table-selector>
+        <unit-price currency="USD">4.99</unit-price>
+      </item>
+      <item>
+        <merchant-item-id>MGS2GBMP3</merchant-item-id>
+        <item-name>Megasound 2GB MP3 Player</item-name>
+        <item-description>portable player</item-description>
+        <quantity>1</quantity>
+        <unit-price currency="USD">179.99</unit-price>
+        <merchant-private-item-data>
+          <merchant-product-id>1234567890</merchant-product-id>
+        </merchant-private-item-data>
+      </item>
+    </items>
+  </shopping-cart>
+  <order-adjustment>
+    <merchant-codes/>
+    <total-tax currency="USD">11.05</total-tax>
+    <adjustment-total currency="USD">11.05</adjustment-total>
+  </order-adjustment>
+  <timestamp>2007-03-19T15:06:26.051Z</timestamp>
+  <buyer-marketing-preferences><email-allowed>false</email-allowed></buyer-marketing-preferences>
+  <order-total currency="USD">190.98</order-total>
+</new-order-notification>""",
+    'risk-information-notification': """<?xml version="1.0" encoding="UTF-8"?>
+<risk-information-notification %(ns)s serial-number="0b95f758-0332-45d5-aced-5da64c8fc5b9">
+  <google-order-number>841171949013218</google-order-number>
+  <risk-information>
+    <eligible-for-protection>true</eligible-for-protection>
+    <billing-address>%(address)s</billing-address>
+    <avs-response>Y</avs-response>
+    <cvn-response>M</cvn-response>
+    <partial-cc-number>3719</partial-cc-number>
+    <ip-address>10.11.12.13</ip-address>
+    <buyer-account-age>6</buyer-account-age>
+  </risk-information>
+  <timestamp>2007-03-19T15:06:29.051Z</timestamp>
+</risk-information-notification>""",
+    'order-state-change-notification': """<?xml version="1.0" encoding="UTF-8"?>
+<order-state-change-notification %(ns)s serial-number="c821426e-7caa-4d51-9b2e-48ef7ecd6423">
+  <google-order-number>841171949013218</google-order-number>
+  <new-financial-order-state>CHARGING</new-financial-order-state>
+  <new-fulfillment-order-state>NEW</new-fulfillment-order-state>
+  <previous-financial-order-state>CHARGEABLE</previous-financial-order-state>
+  <previous-fulfillment-order-state>NEW</previous-fulfillment-order-state>
+  <timestamp>2007-03-19T15:06:26.051Z</timestamp>
+</order-state-change-notification>""",
+    'charge-amount-notification': """<?xml version="1.0" encoding="UTF-8"?>
+<charge-amount-notification %(ns)s serial-number="95d44287-12b1-4722-bc56-cfaa73f4c0d1">
+  <google-order-number>841171949013218</google-order-number>
+  <latest-charge-amount currency="USD">226.06</latest-charge-amount>
+  <total-charge-amount currency="USD">226.06</total-charge-amount>
+  <timestamp>2006-03-18T18:25:31.593Z</timestamp>
+</charge-amount-notification>""",
+    'refund-amount-notification': """<?xml version="1.0" encoding="UTF-8"?>
+<refund-amount-notification %(ns)s serial-number="95d44287-12b1-4722-bc56-cfaa73f4c0d2">
+  <google-order-number>841171949013218</google-order-number>
+  <latest-refund-amount currency="USD">226.06</latest-refund-amount>
+  <total-refund-amount currency="USD">226.06</total-refund-amount>
+  <timestamp>2006-03-18T20:25:31.593Z</timestamp>
+</refund-amount-notification>""",
+    'chargeback-amount-notification': """<?xml version="1.0" encoding="UTF-8"?>
+<chargeback-amount-notification %(ns)s serial-number="95d44287-12b1-4722-bc56-cfaa73f4c0d3">
+  <google-order-number>841171949013218</google-order-number>
+  <latest-chargeback-amount currency="GBP">226.06</latest-chargeback-amount>
+  <total-chargeback-amount currency="GBP">226.06</total-chargeback-amount>
+  <timestamp>2006-03-18T20:25:31.593Z</timestamp>
+</chargeback-amount-notification>""",
+    'authorization-amount-notification': """<?xml version="1.0" encoding="UTF-8"?>
+<authorization-amount-notification %(ns)s serial-number="95d44287-12b1-4722-bc56-cfaa73f4c0d4">
+  <google-order-number>841171949013218</google-order-number>
+  <authorization-amount currency="USD">226.06</authorization-amount>
+  <authorization-expiration-date>2006-03-18T20:25:31.593Z</authorization-expiration-date>
+  <avs-response>Y</avs-response>
+  <cvn-response>M</cvn-response>
+  <timestamp>2006-03-18T20:25:31.593Z</timestamp>
+</authorization-amount-notification>""",
+}
+NOTIFICATIONS = dict((name, xml % {'ns': NS, 'address': ADDRESS}) for name, xml in NOTIFICATIONS.items())
+
+def reference(xmlstr):
+    "the DotDict the minidom based implementation builds"
+    return node_to_dotdict(minidom.parseString(xmlstr).documentElement)
+
+def plain(value):
+    "value with every (lazy) dict converted through __getitem__ into a plain dict"
+    if isinstance(value, dict):
+        return dict((key, plain(value[key])) for key in value.keys())
+    if isinstance(value, list):
+        return [plain(v) for v in value]
+    return value
+
+
+class ParseNotificationTest(unittest.TestCase):
+    "parse_notification must build exactly what node_to_dotdict builds"
+
+    def assertMatchesReference(self, xmlstr):
+        expected = plain(reference(xmlstr))
+        eager = parse_notification(xmlstr)[2]
+        self.assertEqual(type(eager), DotDict)
+        self.assertEqual(plain(eager), expected)
+        lazy = parse_notification(xmlstr, lazy=True)[2]
+        self.assertTrue(isinstance(lazy, LazyDotDict))
+        self.assertEqual(plain(lazy), expected)
+        # and again once everything has been converted
+        self.assertEqual(plain(lazy.materialize()), expected)
+
+    def test_notification_types(self):
+        self.assertEqual(len(NOTIFICATIONS), 7)
+        for notification_type, xmlstr in NOTIFICATIONS.items():
+            parsed_type, serial, notification = parse_notification(xmlstr)
+            self.assertEqual(parsed_type, notification_type)
+            self.assertEqual(serial, minidom.parseString(xmlstr).documentElement.getAttribute('serial-number'))
+            self.assertMatchesReference(xmlstr)
+
+    def test_repeated_elements(self):
+        xmlstr = '<a %s serial-number="1"><b>1</b><b>2</b><b><c>3</c></b><d><e>x</e></d><d>y</d></a>' % NS
+        self.assertMatchesReference(xmlstr)
+        self.assertEqual(parse_notification(xmlstr)[2].b[:2], [u'1', u'2'])
+
+    def test_items(self):
+        xmlstr = NOTIFICATIONS['new-order-notification']
+        for lazy in (False, True):
+            items = parse_notification(xmlstr, lazy=lazy)[2].shopping_cart.items
+            self.assertEqual([item.item_name for item in items], [u'Dry Food Pack', u'Megasound 2GB MP3 Player'])
+
+    def test_currency(self):
+        xmlstr = NOTIFICATIONS['chargeback-amount-notification']
+        self.assertMatchesReference(xmlstr)
+        for lazy in (False, True):
+            notification = parse_notification(xmlstr, lazy=lazy)[2]
+            self.assertEqual(notification.latest_chargeback_amount, u'226.06')
+            self.assertEqual(notification.latest_chargeback_amount_currency, u'GBP')
+
+    def test_split_text(self):
+        self.assertMatchesReference('<a %s serial-number="1"><b>one <![CDATA[<two>]]> three</b></a>' % NS)
+        self.assertMatchesReference('<a %s serial-number="1"><b>one<!-- comment -->two</b></a>' % NS)
+        self.assertMatchesReference('<a %s serial-number="1"><b>one<?pi data?>two</b></a>' % NS)
+        self.assertMatchesReference('<a %s serial-number="1"><b><![CDATA[]]>text</b></a>' % NS)
+        self.assertMatchesReference('<a %s serial-number="1"><b>&lt;&amp;&#233;</b></a>' % NS)
+
+    def test_mixed_content(self):
+        self.assertMatchesReference('<a %s serial-number="1"><b>text<c>1</c></b></a>' % NS)
+        self.assertMatchesReference('<a %s serial-number="1"><b><c>1</c>text</b></a>' % NS)
+        self.assertMatchesReference('<a %s serial-number="1"><b>  <c>1</c>  </b><d/></a>' % NS)
+
+    def test_dict_method_names(self):
+        xmlstr = ('<a %s serial-number="1"><keys>1</keys><keys>2</keys><values><x>1</x></values>'
+                  '<get>g</get><items><item>1</item></items><items><item>2</item></items>'
+                  '<copy currency="USD">1.00</copy></a>' % NS)
+        self.assertMatchesReference(xmlstr)
+
+
+class Request(object):
+    def __init__(self, body, authorization=None):
+        self.body = body
+        self.headers = {}
+        if authorization:
+            self.headers['Authorization'] = authorization
+
+class Response(object):
+    def __init__(self):
+        self.out = StringIO()
+        self.headers = {}
+        self.status = 200
+    def set_status(self, status):
+        self.status = status
+    def clear(self):
+        self.out = StringIO()
+
+MERCHANT_ID, MERCHANT_KEY = '1234567890', 'HsYXFoZfHAqyLcCRYeH8qQ'
+
+def basic_auth(merchant_id=MERCHANT_ID, merchant_key=MERCHANT_KEY):
+    return 'Basic ' + base64.b64encode('%s:%s' % (merchant_id, merchant_key))
+
+def make_handler(handler_class, body, authorization=None):
+    handler = handler_class()
+    handler.initialize(Request(body, authorization or basic_auth()), Response())
+    return handler
+
+class Handler(googlecheckout.NotificationHandler):
+    def merchant_details(self):
+        return (MERCHANT_ID, MERCHANT_KEY)
+
+
+class LazyNotificationTest(unittest.TestCase):
+
+    def test_eager_by_default(self):
+        seen = []
+        class H(Handler):
+            def new_order(self):
+                seen.append(dict(self.notification))
+        make_handler(H, NOTIFICATIONS['new-order-notification']).post()
+        self.assertEqual(type(seen[0]['shopping_cart']), DotDict)
+        self.assertEqual(seen[0], reference(NOTIFICATIONS['new-order-notification']))
+
+    def test_lazy_copy(self):
+        lazy = parse_notification(NOTIFICATIONS['new-order-notification'], lazy=True)[2]
+        copy = lazy.copy()
+        self.assertEqual(plain(dict(copy)), plain(reference(NOTIFICATIONS['new-order-notification'])))
+        self.assertTrue(isinstance(dict(copy)['shopping_cart'], DotDict))
+
+
+class TypedNotificationTest(unittest.TestCase):
+
+    def views(self, notification_type):
+        "the view of a notification from an eager and from a lazy parse"
+        xmlstr = NOTIFICATIONS[notification_type]
+        eager = googlecheckout.notification_view(*parse_notification(xmlstr))
+        lazy = googlecheckout.notification_view(*parse_notification(xmlstr, lazy=True))
+        self.assertEqual(eager, lazy)
+        self.assertEqual(type(eager), googlecheckout.NOTIFICATION_VIEWS[notification_type])
+        self.assertEqual(eager.notification_type, notification_type)
+        self.assertEqual(eager.google_order_number, u'841171949013218')
+        return eager
+
+    def test_new_order(self):
+        view = self.views('new-order-notification')
+        self.assertEqual(type(view).__name__, 'NewOrderNotification')
+        self.assertEqual((view.order_total, view.currency), (Decimal('190.98'), u'USD'))
+        self.assertEqual(view.serial_number, u'85f54628-538a-44fc-8605-ae62364f6c71')
+        self.assertEqual(view.timestamp, datetime(2007, 3, 19, 15, 6, 26, 51000))
+        self.assertEqual(view.email_allowed, False)
+        self.assertEqual(view.financial_order_state, u'REVIEWING')
+        self.assertEqual([(item.merchant_item_id, item.unit_price, item.quantity) for item in view.items],
+            [(u'GGLAA1453', Decimal('4.99'), 1), (u'MGS2GBMP3', Decimal('179.99'), 1)])
+        self.assertEqual(view.buyer_shipping_address.city, u'Sampleville')
+        self.assertEqual(view.buyer_billing_address.company_name, None)
+
+    def test_other_types(self):
+        view = self.views('risk-information-notification')
+        self.assertEqual((view.eligible_for_protection, view.buyer_account_age), (True, 6))
+        self.assertEqual(view.billing_address.postal_code, u'94141')
+        view = self.views('order-state-change-notification')
+        self.assertEqual((view.new_financial_order_state, view.reason), (u'CHARGING', None))
+        view = self.views('charge-amount-notification')
+        self.assertEqual((view.latest_charge_amount, view.total_charge_amount), (Decimal('226.06'), Decimal('226.06')))
+        view = self.views('refund-amount-notification')
+        self.assertEqual(view.total_refund_amount, Decimal('226.06'))
+        view = self.views('chargeback-amount-notification')
+        self.assertEqual((view.latest_chargeback_amount, view.currency), (Decimal('226.06'), u'GBP'))
+        view = self.views('authorization-amount-notification')
+        self.assertEqual(view.authorization_expiration_date, datetime(2006, 3, 18, 20, 25, 31, 593000))
+        self.assertEqual(view.avs_response, u'Y')
+
+    def test_unknown_type(self):
+        xmlstr = '<merchant-calculation-callback %s serial-number="1"/>' % NS
+        self.assertEqual(googlecheckout.notification_view(*parse_notification(xmlstr)), None)
+
+    def test_lazy_parts_not_converted(self):
+        notification = parse_notification(NOTIFICATIONS['new-order-notification'], lazy=True)[2]
+        googlecheckout.notification_view('new-order-notification', '1', notification)
+        self.assertEqual(type(dict.__getitem__(notification, 'shopping_cart')), googlecheckout._LazyElement)
+
+    def test_slots(self):
+        view = self.views('charge-amount-notification')
+        self.assertRaises(AttributeError, setattr, view, 'unknown', 1)
+        self.assertFalse(hasattr(view, '__dict__'))
+        self.assertEqual(sorted(view.as_dict()), ['currency', 'google_order_number', 'latest_charge_amount',
+            'timestamp', 'total_charge_amount'])
+
+    def test_timestamps(self):
+        to_timestamp = googlecheckout._to_timestamp
+        self.assertEqual(to_timestamp(u'2007-03-19T15:06:26.051Z'), datetime(2007, 3, 19, 15, 6, 26, 51000))
+        self.assertEqual(to_timestamp(u'2007-03-19T15:06:26Z'), datetime(2007, 3, 19, 15, 6, 26))
+        self.assertEqual(to_timestamp(u'2006-03-18T20:25:31-08:00'), datetime(2006, 3, 19, 4, 25, 31))
+        self.assertEqual(to_timestamp(u'2006-03-18T20:25:31.5+0530'), datetime(2006, 3, 18, 14, 55, 31, 500000))
+        self.assertEqual(to_timestamp(u' 2006-03-18T20:25:31 '), datetime(2006, 3, 18, 20, 25, 31))
+        self.assertEqual(to_timestamp(None), None)
+        self.assertRaises(ValueError, to_timestamp, u'yesterday')
+
+    def test_compile_getter(self):
+        compile_getter = googlecheckout._compile_getter
+        node = DotDict(a=DotDict(b=u' 1.50 ', b_currency=u'EUR', flag=u'true', n=u'x'), c=[u'1', u'2'])
+        self.assertEqual(compile_getter(('a', 'b'), 'amount')(node), Decimal('1.50'))
+        self.assertEqual(compile_getter(('a', 'b'), 'currency')(node), u'EUR')
+        self.assertEqual(compile_getter(('a', 'flag'), 'bool')(node), True)
+        self.assertEqual(compile_getter(('c',), 'int')(node), 1)
+        self.assertEqual(compile_getter(('a', 'missing', 'b'), 'text')(node), None)
+        self.assertEqual(compile_getter(('a', 'missing'), ('tuple', 'Item'))(node), ())
+        # values that can not be converted are left as text
+        self.assertEqual(compile_getter(('a', 'n'), 'amount')(node), u'x')
+        self.assertEqual(compile_getter(('a', 'n'), 'timestamp')(node), u'x')
+        items = DotDict(item=[DotDict(item_name=u'one'), DotDict(item_name=u'two')])
+        get_items = compile_getter(('items', 'item'), ('tuple', 'Item'))
+        self.assertEqual([item.item_name for item in get_items(DotDict(items=items))], [u'one', u'two'])
+        self.assertEqual(compile_getter(('address',), 'Address')(DotDict(address=DotDict(city=u'X'))).city, u'X')
+
+    def test_typed_handler(self):
+        seen = []
+        class H(Handler):
+            typed_notifications = True
+            def authorization_amount(self):
+                seen.append((self.notification, self.raw_notification))
+        body = NOTIFICATIONS['authorization-amount-notification'].replace(
+            '2006-03-18T20:25:31.593Z</authorization', '2006-03-18T20:25:31-08:00</authorization')
+        handler = make_handler(H, body)
+        handler.post()
+        self.assertEqual(handler.response.status, 200)
+        view, raw = seen[0]
+        self.assertEqual(view.authorization_expiration_date, datetime(2006, 3, 19, 4, 25, 31))
+        self.assertEqual(view.authorization_amount, Decimal('226.06'))
+        self.assertEqual(raw.authorization_expiration_date, u'2006-03-18T20:25:31-08:00')
+
+
+class MultiMerchantHandler(googlecheckout.NotificationHandler):
+    seen = []
+    def merchant_accounts(self):
+        return [('A', 'key-a'), ('B', 'key-b')]
+    def new_order(self):
+        self.seen.append(self.remote_order.merchant_id)
+
+class CredentialsTest(unittest.TestCase):
+
+    def setUp(self):
+        del MultiMerchantHandler.seen[:]
+
+    def post(self, authorization, handler_class=MultiMerchantHandler):
+        handler = make_handler(handler_class, NOTIFICATIONS['new-order-notification'], authorization)
+        handler.post()
+        return handler
+
+    def test_accounts(self):
+        self.assertEqual(self.post(basic_auth('A', 'key-a')).response.status, 200)
+        self.assertEqual(self.post(basic_auth('B', 'key-b')).response.status, 200)
+        self.assertEqual(MultiMerchantHandler.seen, ['A', 'B'])
+        self.assertEqual(self.post(basic_auth(), Handler).merchant_account, (MERCHANT_ID, MERCHANT_KEY))
+
+    def test_rejected(self):
+        for authorization in (basic_auth('A', 'key-b'), basic_auth('C', 'key-a'), basic_auth('A', 'key-a2'),
+                'Basic ' + base64.b64encode('A'), 'Basic ' + base64.b64encode('A:key-a:x'), 
+                'Basic !!!', 'Basic', 'Bearer ' + base64.b64encode('A:key-a'), basic_auth('A', 'key-a')[1:],
+                u'Basic \xe9'):
+            handler = self.post(authorization)
+            self.assertEqual(handler.response.status, 401, authorization)
+            self.assertEqual(handler.outcome, 'unauthorized')
+        self.assertEqual(MultiMerchantHandler.seen, [])
+
+    def test_encoding_variants(self):
+        token = base64.b64encode('A:key-a')
+        for authorization in ('basic ' + token, 'Basic  %s ' % token, 'Basic %s\n%s' % (token[:4], token[4:])):
+            self.assertEqual(self.post(authorization).response.status, 200, authorization)
+
+    def test_replay_needs_account(self):
+        body = NOTIFICATIONS['new-order-notification']
+        self.assertRaises(googlecheckout.Error, MultiMerchantHandler().replay, body)
+        MultiMerchantHandler().replay(body, 'B')
+        self.assertEqual(MultiMerchantHandler.seen, ['B'])
+        self.assertRaises(googlecheckout.Error, MultiMerchantHandler().replay, body, 'C')
+        # a single account is always known
+        seen = []
+        class H(Handler):
+            def new_order(self):
+                seen.append(self.remote_order.merchant_id)
+        H().replay(body)
+        self.assertEqual(seen, [MERCHANT_ID])
+
+    def test_queued(self):
+        path = tempfile.mktemp(suffix='.db')
+        try:
+            class H(MultiMerchantHandler):
+                work_queue = googlecheckout.NotificationQueue(path)
+            self.post(basic_auth('B', 'key-b'), H)
+            self.assertEqual(MultiMerchantHandler.seen, [])
+            googlecheckout.NotificationWorker(H).run_pending()
+            self.assertEqual(MultiMerchantHandler.seen, ['B'])
+        finally:
+            os.remove(path)
+
+
+class DispatchTest(unittest.TestCase):
+
+    def test_handles_order(self):
+        calls = []
+        class A(Handler):
+            @googlecheckout.handles('charge-amount-notification')
+            def second(self):
+                calls.append('A.second')
+            @googlecheckout.handles('charge-amount-notification', 'refund-amount-notification')
+            def first(self):
+                calls.append('A.first')
+            def charge_amount(self):
+                calls.append('A.charge_amount')
+        class B(A):
+            @googlecheckout.handles('charge-amount-notification')
+            def another(self):
+                calls.append('B.another')
+        make_handler(B, NOTIFICATIONS['charge-amount-notification']).post()
+        self.assertEqual(calls, ['A.charge_amount', 'A.second', 'A.first', 'B.another'])
+        self.assertEqual(len(B._dispatch_table()['refund-amount-notification']), 1)
+
+    def test_override_keeps_registration(self):
+        calls = []
+        class A(Handler):
+            @googlecheckout.handles('charge-amount-notification', 'refund-amount-notification')
+            def update_balance(self):
+                calls.append('A')
+        class B(A):
+            def update_balance(self):
+                calls.append('B')
+        class C(A):
+            @googlecheckout.handles('refund-amount-notification')
+            def update_balance(self):
+                calls.append('C')
+        self.assertEqual(sorted(B._dispatch_table()), ['charge-amount-notification', 'refund-amount-notification'])
+        self.assertEqual(sorted(C._dispatch_table()), ['refund-amount-notification'])
+        make_handler(B, NOTIFICATIONS['charge-amount-notification']).post()
+        self.assertEqual(calls, ['B'])
+
+    def test_middleware(self):
+        calls = []
+        def log(handler, call_next):
+            calls.append(handler.notification_type)
+            call_next()
+        def ignore(handler, call_next):
+            raise googlecheckout.IgnoreNotification("ignored by middleware")
+        class H(Handler):
+            middleware = [log, ignore]
+            def new_order(self):
+                calls.append('new_order')
+        handler = make_handler(H, NOTIFICATIONS['new-order-notification'])
+        handler.post()
+        self.assertEqual(calls, ['new-order-notification'])
+        self.assertEqual(handler.outcome, 'ignored')
+        self.assertTrue('notification-acknowledgment' in handler.response.out.getvalue())
+
+
+def state_change(financial_state, timestamp, serial_number):
+    return ('<order-state-change-notification %s serial-number="%s">'
+        '<google-order-number>841171949013218</google-order-number>'
+        '<new-financial-order-state>%s</new-financial-order-state>'
+        '<new-fulfillment-order-state>NEW</new-fulfillment-order-state>'
+        '<timestamp>%s</timestamp></order-state-change-notification>' % (NS, serial_number, financial_state, timestamp))
+
+class UnhandledFastPathTest(unittest.TestCase):
+
+    def post(self, handler_class, notification_type):
+        parsed = []
+        class H(handler_class):
+            def _parse_notification(self, body=None):
+                parsed.append(self.notification_type)
+                return handler_class._parse_notification(self, body)
+        handler = make_handler(H, NOTIFICATIONS[notification_type])
+        handler.post()
+        self.assertTrue(handler.notification_serial_number in handler.response.out.getvalue())
+        return handler, parsed
+
+    def test_unhandled_not_parsed(self):
+        class H(Handler):
+            def new_order(self):
+                pass
+        handler, parsed = self.post(H, 'charge-amount-notification')
+        self.assertEqual((handler.outcome, parsed), ('ignored', []))
+        handler, parsed = self.post(H, 'new-order-notification')
+        self.assertEqual((handler.outcome, parsed), ('handled', ['new-order-notification']))
+
+    def test_overridden(self):
+        seen = []
+        class Unhandled(Handler):
+            def unhandled_notification(self):
+                seen.append(self.notification.google_order_number)
+        class Process(Handler):
+            def _process_notification(self):
+                seen.append(self.notification_type)
+        for cls in Unhandled, Process:
+            self.assertEqual(cls._handled_notification_types(), None)
+            handler, parsed = self.post(cls, 'charge-amount-notification')
+            self.assertEqual(parsed, ['charge-amount-notification'])
+        self.assertEqual(seen, [u'841171949013218', 'charge-amount-notification'])
+        self.assertEqual(Handler._handled_notification_types(), frozenset())
+
+    def test_order_states_parsed(self):
+        class H(Handler):
+            order_states = googlecheckout.OrderStateStore()
+        handler, parsed = self.post(H, 'charge-amount-notification')
+        self.assertEqual((handler.outcome, parsed), ('ignored', ['charge-amount-notification']))
+        self.assertEqual(H.order_states.get('841171949013218').total_charged, Decimal('226.06'))
+        # types order_states doesn't project are still skipped
+        handler, parsed = self.post(H, 'risk-information-notification')
+        self.assertEqual(parsed, [])
+
+
+class OrderStateStoreTest(unittest.TestCase):
+
+    def apply(self, store, xmlstr):
+        notification_type, serial_number, notification = parse_notification(xmlstr)
+        return store.apply(notification_type, notification, serial_number)
+
+    def test_projection(self):
+        store = googlecheckout.OrderStateStore()
+        self.apply(store, NOTIFICATIONS['new-order-notification'])
+        state = self.apply(store, NOTIFICATIONS['charge-amount-notification'])
+        self.assertEqual(state.financial_order_state, u'REVIEWING')
+        self.assertEqual(state.order_total, Decimal('190.98'))
+        self.assertEqual(state.total_charged, Decimal('226.06'))
+        self.assertEqual(state.currency, u'USD')
+
+    def test_redelivered_older_notification(self):
+        store = googlecheckout.OrderStateStore()
+        charging = state_change('CHARGING', '2007-03-19T15:06:26.051Z', 'sn-1')
+        self.apply(store, charging)
+        self.apply(store, state_change('CHARGED', '2007-03-19T15:07:00Z', 'sn-2'))
+        state = self.apply(store, charging)
+        self.assertEqual(state.financial_order_state, u'CHARGED')
+        self.assertEqual(state.last_serial_number, 'sn-2')
+        # fields set by other notifications are still updated by older ones
+        self.apply(store, NOTIFICATIONS['new-order-notification'])
+        self.assertEqual(state.financial_order_state, u'CHARGED')
+        self.assertEqual(state.order_total, Decimal('190.98'))
+
+    def test_persistence(self):
+        path = tempfile.mktemp(suffix='.db')
+        try:
+            store = googlecheckout.OrderStateStore(path)
+            self.apply(store, state_change('CHARGED', '2007-03-19T15:07:00Z', 'sn-2'))
+            store = googlecheckout.OrderStateStore(path)
+            state = self.apply(store, state_change('CHARGING', '2007-03-19T15:06:26.051Z', 'sn-1'))
+            self.assertEqual(state.financial_order_state, u'CHARGED')
+        finally:
+            os.remove(path)
+
+
+class ReplayTest(unittest.TestCase):
+
+    def test_bad_records(self):
+        seen = []
+        class H(Handler):
+            def charge_amount(self):
+                seen.append(self.notification_serial_number)
+        charge = NOTIFICATIONS['charge-amount-notification']
+        path = tempfile.mktemp(suffix='.jsonl')
+        try:
+            f = open(path, 'w')
+            f.write("\n".join([json.dumps(charge), json.dumps({'body': charge[:60]}), 
+                '{"no": "body"}', '{not json', json.dumps({'body': charge})]))
+            f.close()
+            summary = googlecheckout.replay_notifications(H, path, processes=1)
+        finally:
+            os.remove(path)
+        self.assertEqual(summary.total, 5)
+        self.assertEqual([index for index, error in summary.failures], [1, 2, 3])
+        self.assertTrue(summary.failures[0][1].startswith('ExpatError'))
+        self.assertTrue('line 3' in summary.failures[1][1])
+        self.assertEqual(len(seen), 2)
+
+
+class SerialStoreTest(unittest.TestCase):
+
+    def test_base_class(self):
+        store = googlecheckout.SerialStore()
+        self.assertRaises(googlecheckout.Error, store.get, 'sn-1')
+        self.assertRaises(googlecheckout.Error, store.set, 'sn-1', store.DONE)
+
+    def test_redelivery(self):
+        calls = []
+        class H(Handler):
+            serial_store = googlecheckout.MemorySerialStore()
+            def new_order(self):
+                calls.append(self.notification_serial_number)
+        for i in range(2):
+            handler = make_handler(H, NOTIFICATIONS['new-order-notification'])
+            handler.post()
+            self.assertTrue('85f54628-538a-44fc-8605-ae62364f6c71' in handler.response.out.getvalue())
+        self.assertEqual(calls, ['85f54628-538a-44fc-8605-ae62364f6c71'])
+
+    def test_failed_is_retried(self):
+        calls = []
+        class H(Handler):
+            serial_store = googlecheckout.MemorySerialStore()
+            def new_order(self):
+                calls.append(1)
+                if len(calls) == 1:
+                    raise ValueError
+        self.assertRaises(ValueError, make_handler(H, NOTIFICATIONS['new-order-notification']).post)
+        make_handler(H, NOTIFICATIONS['new-order-notification']).post()
+        self.assertEqual(len(calls), 2)
+
+
+class NotificationQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mktemp(suffix='.db')
+        self.calls = []
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def handler(self, fail=False, **attributes):
+        calls = self.calls
+        class H(Handler):
+            def new_order(self):
+                calls.append(self.notification_serial_number)
+                if fail:
+                    raise ValueError("down")
+        for name, value in attributes.items():
+            setattr(H, name, value)
+        return H
+
+    def test_duplicates(self):
+        queue = googlecheckout.NotificationQueue(self.path)
+        H = self.handler(serial_store=googlecheckout.MemorySerialStore(), work_queue=queue)
+        body = NOTIFICATIONS['new-order-notification']
+        outcomes = []
+        for i in range(2):
+            handler = make_handler(H, body)
+            handler.post()
+            outcomes.append(handler.outcome)
+        self.assertEqual(outcomes, ['queued', 'duplicate'])
+        self.assertEqual(len(queue), 1)
+        # queued without a serial number (eg. by an older version)
+        queue.put(body)
+        googlecheckout.NotificationWorker(H).run_pending()
+        self.assertEqual(self.calls, ['85f54628-538a-44fc-8605-ae62364f6c71'])
+        self.assertEqual(len(queue), 0)
+        handler = make_handler(H, body)
+        handler.post()
+        self.assertEqual(handler.outcome, 'duplicate')
+        self.assertEqual(len(queue), 0)
+
+    def test_backoff(self):
+        queue = googlecheckout.NotificationQueue(self.path, backoff=30)
+        queue.put(NOTIFICATIONS['new-order-notification'])
+        now = time.time()
+        googlecheckout.NotificationWorker(self.handler(fail=True, work_queue=queue)).run_pending()
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(queue.claim(), None)
+        [(attempts, next_attempt, error)] = queue._execute("SELECT attempts, next_attempt, last_error FROM notifications")
+        self.assertEqual(attempts, 1)
+        self.assertTrue(now + 15 <= next_attempt <= time.time() + 30)
+        self.assertTrue('down' in error)
+
+    def test_dead_letters(self):
+        queue = googlecheckout.NotificationQueue(self.path, max_attempts=3, backoff=0)
+        body = NOTIFICATIONS['new-order-notification']
+        queue.put(body)
+        googlecheckout.NotificationWorker(self.handler(fail=True, work_queue=queue)).run_pending()
+        self.assertEqual(len(self.calls), 3)
+        self.assertEqual(len(queue), 0)
+        [(id, dead_body, attempts, error)] = queue.dead_letters()
+        self.assertEqual((dead_body, attempts), (body, 3))
+        self.assertTrue('down' in error)
+        # a dead notification doesn't block a redelivery
+        self.assertTrue(queue.put(body, serial_number='85f54628-538a-44fc-8605-ae62364f6c71'))
+        queue.done(queue.claim()[0])
+
+        queue.retry_dead(id + 1)
+        self.assertEqual(len(queue), 0)
+        queue.retry_dead(id)
+        self.assertEqual((len(queue), queue.dead_letters()), (1, []))
+        googlecheckout.NotificationWorker(self.handler(work_queue=queue)).run_pending()
+        self.assertEqual(len(self.calls), 4)
+        self.assertEqual((len(queue), queue.dead_letters()), (0, []))
+
+        queue.put(body)
+        queue.put(body)
+        for i in range(2):
+            queue.failed(queue.claim()[0])
+            queue.failed(queue.claim()[0])
+            queue.failed(queue.claim()[0])
+        self.assertEqual(len(queue.dead_letters()), 2)
+        queue.retry_dead()
+        self.assertEqual((len(queue), queue.dead_letters()), (2, []))
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_base_class(self):
+        class Counting(googlecheckout.Metrics):
+            pass
+        self.assertRaises(googlecheckout.Error, Counting().increment, 'notifications_total', {})
+        try:
+            Counting().observe('notification_seconds', 0.1, {})
+        except googlecheckout.Error, e:
+            self.assertTrue('Counting.observe' in str(e))
+
+    def test_outcomes(self):
+        metrics = googlecheckout.HistogramMetrics()
+        class H(Handler):
+            def new_order(self):
+                pass
+        H.metrics = metrics
+        make_handler(H, NOTIFICATIONS['new-order-notification']).post()
+        make_handler(H, NOTIFICATIONS['charge-amount-notification']).post()
+        make_handler(H, NOTIFICATIONS['charge-amount-notification'], basic_auth(merchant_key='x')).post()
+        self.assertEqual(metrics.counter('notifications_total', type='new-order-notification', outcome='handled'), 1)
+        self.assertEqual(metrics.counter('notifications_total', type='charge-amount-notification', outcome='ignored'), 1)
+        self.assertEqual(metrics.counter('notifications_total', type='unknown', outcome='unauthorized'), 1)
+
+
+class WSGITest(unittest.TestCase):
+
+    def call(self, handler_class, body='', method='POST', **environ):
+        environ.update({'REQUEST_METHOD': method, 'CONTENT_LENGTH': str(len(body)), 'wsgi.input': StringIO(body)})
+        started = []
+        def start_response(status, headers):
+            started.append((status, dict(headers)))
+        result = googlecheckout.wsgi_application(handler_class)(environ, start_response)
+        status, headers = started[0]
+        body = ''.join(result)
+        self.assertEqual(headers['Content-Length'], str(len(body)))
+        return status, headers, body
+
+    def test_request(self):
+        request = googlecheckout.WSGIRequest({'HTTP_AUTHORIZATION': 'Basic abc', 'HTTP_X_FORWARDED_FOR': '10.0.0.1',
+            'CONTENT_TYPE': 'application/xml', 'CONTENT_LENGTH': '4', 'wsgi.input': StringIO('<a/>trailing'), 
+            'SERVER_NAME': 'localhost'})
+        self.assertEqual(request.headers, {'Authorization': 'Basic abc', 'X-Forwarded-For': '10.0.0.1', 
+            'Content-Type': 'application/xml'})
+        self.assertEqual(request.body, '<a/>')
+        request = googlecheckout.WSGIRequest({'CONTENT_LENGTH': 'x', 'wsgi.input': StringIO('<a/>')})
+        self.assertEqual((request.headers, request.body), ({}, ''))
+
+    def test_response(self):
+        response = googlecheckout.WSGIResponse()
+        self.assertEqual(response.status_line(), '200 OK')
+        response.out.write('partial')
+        response.clear()
+        response.set_status(500)
+        self.assertEqual((response.status_line(), response.out.getvalue()), ('500 Internal Server Error', ''))
+
+    def test_acknowledged(self):
+        calls = []
+        class H(Handler):
+            def new_order(self):
+                calls.append(self.request.headers['Authorization'])
+        status, headers, body = self.call(H, NOTIFICATIONS['new-order-notification'], HTTP_AUTHORIZATION=basic_auth())
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers['Content-Type'], 'text/xml')
+        self.assertEqual(body, googlecheckout.acknowledgment_xml('85f54628-538a-44fc-8605-ae62364f6c71'))
+        self.assertEqual(calls, [basic_auth()])
+
+    def test_errors(self):
+        body = NOTIFICATIONS['new-order-notification']
+        self.assertEqual(self.call(Handler, body)[0], '401 Unauthorized')
+        self.assertEqual(self.call(Handler, body, HTTP_AUTHORIZATION=basic_auth(merchant_key='x'))[0], '401 Unauthorized')
+        self.assertEqual(self.call(Handler, '', HTTP_AUTHORIZATION=basic_auth())[0], '400 Bad Request')
+        status, headers, body = self.call(Handler, method='GET')
+        self.assertEqual((status, headers['Allow'], body), ('405 Method Not Allowed', 'POST', ''))
+
+    def test_handler_raises(self):
+        class H(Handler):
+            def new_order(self):
+                self.response.out.write('partial')
+                raise ValueError
+        status, headers, body = self.call(H, NOTIFICATIONS['new-order-notification'], HTTP_AUTHORIZATION=basic_auth())
+        self.assertEqual((status, body), ('500 Internal Server Error', ''))
+
+
+class FakeCheckout(BaseHTTPServer.BaseHTTPRequestHandler):
+    """answers each POST with the next (status, body, delay) in responses. 
+    with close_after set the connection is closed after each response 
+    without telling the client"""
+    protocol_version = 'HTTP/1.1'
+    responses = []
+    requests = []
+    close_after = False
+
+    def do_POST(self):
+        self.requests.append(self.rfile.read(int(self.headers['Content-Length'])))
+        status, body, delay = self.responses.pop(0) if self.responses else (200, '<ok/>', 0)
+        time.sleep(delay)
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if self.close_after:
+            self.close_connection = 1
+
+    def log_message(self, *args):
+        pass
+
+class FakeCheckoutServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients that time out go away before the response is written
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+class LocalPool(googlecheckout.ConnectionPool):
+    "a ConnectionPool sending everything to the FakeCheckout server over plain http"
+    port = None
+    def _connect(self):
+        return httplib.HTTPConnection('127.0.0.1', self.port, timeout=self.timeout)
+
+ERROR_XML = ('<error xmlns="http://checkout.google.com/schema/2" serial-number="1">'
+    '<error-message>%s</error-message></error>')
+
+class FakeCheckoutTest(unittest.TestCase):
+    "runs a FakeCheckout server and routes the sandbox host to it"
+
+    def setUp(self):
+        self.server = FakeCheckoutServer(('127.0.0.1', 0), FakeCheckout)
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.01})
+        self.thread.start()
+        FakeCheckout.responses = []
+        FakeCheckout.requests = []
+        FakeCheckout.close_after = False
+        LocalPool.port = self.server.server_address[1]
+        self.pool = googlecheckout._pools['sandbox.google.com'] = LocalPool('sandbox.google.com')
+
+    def tearDown(self):
+        googlecheckout._pools.pop('sandbox.google.com', None)
+        for conn, last_used in self.pool._idle:
+            conn.close()
+        googlecheckout._order_classes.clear()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def respond(self, *responses):
+        FakeCheckout.responses.extend((r + (0,))[:3] for r in responses)
+
+
+class ConnectionPoolTest(FakeCheckoutTest):
+
+    def test_reuse(self):
+        for i in range(3):
+            self.assertEqual(self.pool.request('POST', '/', 'body %d' % i), (200, '<ok/>'))
+        self.assertEqual(self.pool.stats(), {'host': 'sandbox.google.com', 'hits': 2, 'misses': 1,
+            'stale': 0, 'idle': 1})
+        self.assertEqual(FakeCheckout.requests, ['body 0', 'body 1', 'body 2'])
+
+    def test_concurrent_connections(self):
+        conns = [self.pool.get() for i in range(3)]
+        self.assertEqual([reused for conn, reused in conns], [False, False, False])
+        for conn, reused in conns:
+            self.pool.put(conn)
+        self.assertEqual(self.pool.stats()['idle'], 3)
+        self.assertEqual(self.pool.get()[1], True)
+
+    def test_idle_timeout(self):
+        self.pool.idle_timeout = 0.05
+        self.pool.request('POST', '/', 'one')
+        time.sleep(0.1)
+        self.pool.request('POST', '/', 'two')
+        stats = self.pool.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['stale']), (0, 2, 1))
+
+    def test_stale_connection(self):
+        FakeCheckout.close_after = True
+        self.pool.request('POST', '/', 'one')
+        # let the server close the connection
+        time.sleep(0.05)
+        self.assertEqual(self.pool.request('POST', '/', 'two'), (200, '<ok/>'))
+        self.assertEqual(FakeCheckout.requests, ['one', 'two'])
+        stats = self.pool.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['stale']), (1, 1, 1))
+
+    def test_error_after_sending(self):
+        sent = []
+        class Connection(object):
+            "a keep-alive connection that was reset after the request was sent"
+            def request(self, method, url, body, headers):
+                sent.append(body)
+            def getresponse(self):
+                raise socket.error(errno.ECONNRESET, 'Connection reset by peer')
+            def close(self):
+                pass
+        self.pool._idle.append((Connection(), time.time()))
+        try:
+            self.pool.request('POST', '/', 'charge')
+        except googlecheckout.NoResponseError, e:
+            self.assertEqual(e.reason.errno, errno.ECONNRESET)
+        else:
+            self.fail("no error")
+        self.assertEqual(sent, ['charge'])
+        self.assertEqual(self.pool.stats()['idle'], 0)
+
+    def test_timeout_not_resent(self):
+        self.pool.timeout = 0.2
+        self.pool.request('POST', '/', 'one')
+        self.respond((200, '<ok/>', 0.5))
+        try:
+            self.pool.request('POST', '/', 'charge')
+        except googlecheckout.NoResponseError, e:
+            self.assertTrue(isinstance(e.reason, socket.timeout))
+        else:
+            self.fail("no error")
+        self.assertEqual(FakeCheckout.requests, ['one', 'charge'])
+
+
+class OrderProcessingTest(FakeCheckoutTest):
+
+    def setUp(self):
+        FakeCheckoutTest.setUp(self)
+        # a fresh Order class for every test
+        self.Order = googlecheckout.Client(MERCHANT_ID, MERCHANT_KEY, sandbox=True, currency=self.id())
+
+    def test_success(self):
+        self.Order('123').charge_and_ship(amount='10.00')
+        self.assertEqual(len(FakeCheckout.requests), 1)
+        self.assertTrue('<charge-and-ship-order google-order-number="123"' in FakeCheckout.requests[0])
+
+    def test_status_mapping(self):
+        for status in (500, 503, 429):
+            self.respond((status, ERROR_XML % 'try later'))
+            try:
+                self.Order('123').cancel()
+            except googlecheckout.RetryableOrderError, e:
+                self.assertEqual((e.status, e.messages), (status, [u'try later']))
+            else:
+                self.fail("no error for %s" % status)
+        for status in (400, 401, 404):
+            self.respond((status, ERROR_XML % 'Bad request'))
+            try:
+                self.Order('123').cancel()
+            except googlecheckout.FatalOrderError, e:
+                self.assertEqual((e.status, e.messages), (status, [u'Bad request']))
+                self.assertFalse(isinstance(e, googlecheckout.RetryableOrderError))
+            else:
+                self.fail("no error for %s" % status)
+
+    def test_non_xml_error_body(self):
+        self.respond((502, '<html><body>Bad Gateway'), (400, 'Bad Request'))
+        self.assertRaises(googlecheckout.RetryableOrderError, self.Order('123').cancel)
+        try:
+            self.Order('123').cancel()
+        except googlecheckout.FatalOrderError, e:
+            self.assertEqual((e.status, e.messages), (400, []))
+
+    def test_retry_policy(self):
+        self.Order.retry_policy = googlecheckout.RetryPolicy(max_attempts=3, backoff=0.001)
+        self.respond((503, ''), (503, ''), (503, ''), (503, ''))
+        self.assertRaises(googlecheckout.RetryableOrderError, self.Order('123').cancel)
+        self.assertEqual(len(FakeCheckout.requests), 3)
+        del FakeCheckout.requests[:]
+        FakeCheckout.responses = []
+        self.respond((500, ''), (200, '<ok/>'))
+        self.Order('123').cancel()
+        self.assertEqual(len(FakeCheckout.requests), 2)
+        # fatal errors are not retried
+        del FakeCheckout.requests[:]
+        self.respond((400, ERROR_XML % 'Bad request'))
+        self.assertRaises(googlecheckout.FatalOrderError, self.Order('123').cancel)
+        self.assertEqual(len(FakeCheckout.requests), 1)
+
+    def test_timeout_not_resent(self):
+        self.pool.timeout = 0.2
+        self.Order('123').cancel()
+        self.respond((200, '<ok/>', 0.5))
+        self.assertRaises(googlecheckout.OrderOutcomeUnknownError, self.Order('123').charge_and_ship)
+        self.assertEqual(len(FakeCheckout.requests), 2)
+
+    def test_timeout_not_retried(self):
+        self.Order.retry_policy = googlecheckout.RetryPolicy(max_attempts=3, backoff=0.001)
+        breaker = self.Order.circuit_breaker = googlecheckout.CircuitBreaker(failure_threshold=1)
+        self.pool.timeout = 0.2
+        self.respond((200, '<ok/>', 0.5))
+        self.assertRaises(googlecheckout.OrderOutcomeUnknownError, self.Order('123').refund, 'reason')
+        time.sleep(0.4)
+        self.assertEqual(len(FakeCheckout.requests), 1)
+        self.assertEqual(breaker.state, 'open')
+
+    def test_not_sent_is_retried(self):
+        self.Order.retry_policy = googlecheckout.RetryPolicy(max_attempts=3, backoff=0.001)
+        # nothing listens on the port any more
+        self.server.shutdown()
+        self.server.server_close()
+        self.assertRaises(googlecheckout.RetryableOrderError, self.Order('123').charge_and_ship)
+        self.assertEqual(self.pool.stats()['misses'], 3)
+
+    def test_no_breaker_by_default(self):
+        self.respond(*[(500, '')] * 10)
+        for i in range(10):
+            self.assertRaises(googlecheckout.RetryableOrderError, self.Order('123').cancel)
+        self.assertEqual(len(FakeCheckout.requests), 10)
+
+    def test_circuit_breaker(self):
+        breaker = self.Order.circuit_breaker = googlecheckout.CircuitBreaker(failure_threshold=2, reset_timeout=0.1)
+        self.respond((500, ''), (500, ''))
+        for i in range(2):
+            self.assertRaises(googlecheckout.RetryableOrderError, self.Order('123').cancel)
+        self.assertEqual(breaker.state, 'open')
+        self.assertRaises(googlecheckout.CircuitOpenError, self.Order('123').cancel)
+        self.assertEqual(len(FakeCheckout.requests), 2)
+        # a failed trial opens it again
+        time.sleep(0.15)
+        self.assertEqual(breaker.state, 'half-open')
+        self.respond((503, ''))
+        self.assertRaises(googlecheckout.RetryableOrderError, self.Order('123').cancel)
+        self.assertRaises(googlecheckout.CircuitOpenError, self.Order('123').cancel)
+        # and a successful one closes it
+        time.sleep(0.15)
+        self.Order('123').cancel()
+        self.assertEqual(breaker.state, 'closed')
+        self.assertEqual(len(FakeCheckout.requests), 4)
+
+    def test_breaker_trial_released(self):
+        class BrokenMetrics(googlecheckout.Metrics):
+            def increment(self, name, labels):
+                raise KeyError(name)
+        breaker = self.Order.circuit_breaker = googlecheckout.CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+        self.respond((500, ''))
+        self.assertRaises(googlecheckout.RetryableOrderError, self.Order('123').cancel)
+        time.sleep(0.1)
+        self.Order.metrics = BrokenMetrics()
+        self.assertRaises(KeyError, self.Order('123').cancel)
+        self.Order.metrics = None
+        self.Order('123').cancel()
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_rate_limiter(self):
+        self.Order.rate_limiter = googlecheckout.TokenBucket(rate=20, burst=2)
+        started = time.time()
+        for i in range(6):
+            self.Order('123').cancel()
+        # the first 2 are a burst, the other 4 are paced at 20 per second
+        self.assertTrue(time.time() - started >= 0.19)
+
+
+class OrderDispatcherTest(FakeCheckoutTest):
+
+    def setUp(self):
+        FakeCheckoutTest.setUp(self)
+        self.Order = googlecheckout.Client(MERCHANT_ID, MERCHANT_KEY, sandbox=True)
+        self.dispatcher = googlecheckout.OrderDispatcher(self.Order, concurrency=4)
+
+    def tearDown(self):
+        self.dispatcher.shutdown()
+        FakeCheckoutTest.tearDown(self)
+
+    def test_run_order(self):
+        # the first request to arrive is answered last
+        self.respond((200, '<ok/>', 0.2))
+        jobs = [('1', 'cancel'), ('2', 'refund', ('reason',)), ('3', 'charge_and_ship', {'amount': '1.00'}),
+                ('4', 'authorize')]
+        results = self.dispatcher.run(jobs)
+        self.assertEqual([(r.order_number, r.command, r.ok) for r in results],
+            [('1', 'cancel', True), ('2', 'refund', True), ('3', 'charge_and_ship', True), ('4', 'authorize', True)])
+        self.assertEqual(len(FakeCheckout.requests), 4)
+        self.assertTrue(any('<amount currency="USD">1.00</amount>' in body for body in FakeCheckout.requests))
+
+    def test_errors(self):
+        self.dispatcher.concurrency = 1
+        self.respond((200, '<ok/>'), (400, ERROR_XML % 'Bad order'))
+        results = self.dispatcher.run([('1', 'cancel'), ('2', 'cancel'), ('3', 'explode'), ('4',), '5', 
+            ('6', 'refund', ('reason',), 'extra')])
+        self.assertEqual([r.ok for r in results], [True, False, False, False, False, False])
+        self.assertTrue(isinstance(results[1].error, googlecheckout.FatalOrderError))
+        self.assertEqual(results[1].messages, [u'Bad order'])
+        self.assertEqual(results[0].messages, [])
+        self.assertEqual([(r.order_number, r.command) for r in results[2:5]], [('3', 'explode'), ('4', None), ('5', None)])
+        for result in results[2:]:
+            self.assertTrue(isinstance(result.error, ValueError))
+            self.assertEqual(result.messages, [])
+        self.assertEqual(len(FakeCheckout.requests), 2)
+
+    def test_submit(self):
+        if googlecheckout.futures is None:
+            self.assertRaises(googlecheckout.Error, self.dispatcher.submit, '1', 'cancel')
+            return
+        result = self.dispatcher.submit('1', 'refund', {'reason': 'r'}).result()
+        self.assertEqual((result.order_number, result.command, result.ok), ('1', 'refund', True))
+        self.respond((500, ERROR_XML % 'try later'))
+        result = self.dispatcher.submit('2', 'cancel').result()
+        self.assertTrue(isinstance(result.error, googlecheckout.RetryableOrderError))
+
+
+class PeekTest(unittest.TestCase):
+
+    def test_peek(self):
+        for notification_type, xmlstr in NOTIFICATIONS.items():
+            serial = parse_notification(xmlstr)[1]
+            self.assertEqual(googlecheckout.peek_notification(xmlstr), (notification_type, serial))
+            self.assertEqual(googlecheckout.peek_order_number(xmlstr), u'841171949013218')
+
+
+
+class MinidomOrder(object):
+    "the original minidom implementation of the order commands, for comparison"
+
+    def __init__(self, order_number, currency):
+        self.order_number, self.currency = order_number, currency
+
+    def _doc(self, tag):
+        doc = minidom.getDOMImplementation().createDocument(None, tag, None)
+        doc.documentElement.setAttribute("xmlns", "http://checkout.google.com/schema/2")
+        doc.documentElement.setAttribute("google-order-number", self.order_number)
+        return doc
+
+    def _append(self, doc, parent, tag, text, currency=None):
+        el = doc.createElement(tag)
+        if currency is not None:
+            el.setAttribute("currency", currency)
+        el.appendChild(doc.createTextNode(text))
+        parent.appendChild(el)
+
+    def authorize(self):
+        return self._doc("authorize-order").toxml("utf-8")
+
+    def cancel(self, reason="no reason given", comment=""):
+        doc = self._doc("cancel-order")
+        self._append(doc, doc.documentElement, "reason", str(reason))
+        if comment:
+            self._append(doc, doc.documentElement, "comment", str(comment))
+        return doc.toxml("utf-8")
+
+    def refund(self, reason, amount=None, comment=""):
+        doc = self._doc("refund-order")
+        if amount is not None:
+            self._append(doc, doc.documentElement, "amount", str(amount), self.currency)
+        self._append(doc, doc.documentElement, "reason", str(reason))
+        if comment:
+            self._append(doc, doc.documentElement, "comment", str(comment))
+        return doc.toxml("utf-8")
+
+    def charge_and_ship(self, amount=None, carrier=None, carrier_id=None):
+        doc = self._doc("charge-and-ship-order")
+        if amount is not None:
+            self._append(doc, doc.documentElement, "amount", str(amount), self.currency)
+        if carrier is not None or carrier_id is not None:
+            tracking = doc.createElement("tracking-data")
+            if carrier is not None:
+                self._append(doc, tracking, "carrier", carrier)
+            if carrier_id is not None:
+                self._append(doc, tracking, "tracking-number", carrier_id)
+            el = doc.createElement("tracking-data-list")
+            el.appendChild(tracking)
+            doc.documentElement.appendChild(el)
+        return doc.toxml("utf-8")
+
+
+class CommandXMLTest(unittest.TestCase):
+
+    currency = 'USD'
+
+    def assertSameXML(self, order_number, method, *args, **kwargs):
+        sent = []
+        class Order(googlecheckout.Client(MERCHANT_ID, MERCHANT_KEY, sandbox=True, currency=self.currency)):
+            def _request(self, xml):
+                sent.append(xml)
+        getattr(Order(order_number), method)(*args, **kwargs)
+        expected = getattr(MinidomOrder(order_number, self.currency), method)(*args, **kwargs)
+        self.assertEqual(sent, [expected])
+
+    def test_commands(self):
+        for order_number in ('841171949013218', u'841171949013218'):
+            self.assertSameXML(order_number, 'authorize')
+            self.assertSameXML(order_number, 'cancel')
+            self.assertSameXML(order_number, 'cancel', 'out of stock', 'sorry')
+            self.assertSameXML(order_number, 'refund', 'damaged')
+            self.assertSameXML(order_number, 'refund', 'damaged', Decimal('10.50'), 'part refund')
+            self.assertSameXML(order_number, 'charge_and_ship')
+            self.assertSameXML(order_number, 'charge_and_ship', '190.98')
+            self.assertSameXML(order_number, 'charge_and_ship', 190.98, 'UPS', '1Z999')
+
+    def test_amount_currency(self):
+        self.currency = 'GBP'
+        self.assertSameXML('1', 'refund', 'r', '7.25')
+        self.assertSameXML('1', 'charge_and_ship', '7.25')
+        self.currency = u'A&B'
+        self.assertSameXML('1', 'charge_and_ship', '7.25')
+
+    def test_tracking_data(self):
+        self.assertSameXML('1', 'charge_and_ship', carrier='DHL')
+        self.assertSameXML('1', 'charge_and_ship', carrier_id='1Z999')
+        self.assertSameXML('1', 'charge_and_ship', amount='5', carrier_id='1Z999')
+
+    def test_escaping(self):
+        special = 'a & b <c> "d" \'e\''
+        self.assertSameXML(special, 'authorize')
+        self.assertSameXML('1', 'cancel', special, special)
+        self.assertSameXML('1', 'refund', special, special, special)
+        self.assertSameXML('1', 'charge_and_ship', special, special, special)
+        self.assertSameXML(u'n\xfamero', 'charge_and_ship', carrier=u'Z\xfcrich Post \u2603', carrier_id=u'\u00e9 & <>')
+
+    def test_text_element(self):
+        self.assertEqual(googlecheckout._text_element('reason', u'a < b'), u'<reason>a &lt; b</reason>')
+        self.assertEqual(googlecheckout._text_element('amount', '1.00', 'GBP'), u'<amount currency="GBP">1.00</amount>')
+        self.assertEqual(googlecheckout.command_xml('cancel-order', '1', u'<reason>\xe9</reason>'),
+            '<?xml version="1.0" encoding="utf-8"?><cancel-order google-order-number="1" '
+            'xmlns="http://checkout.google.com/schema/2"><reason>\xc3\xa9</reason></cancel-order>')
+
+
+class AcknowledgmentXMLTest(unittest.TestCase):
+
+    def minidom_ack(self, serial_number):
+        "the original minidom acknowledgment, for comparison"
+        doc = minidom.Document()
+        ack = doc.createElement("notification-acknowledgment")
+        ack.setAttribute("xmlns", "http://checkout.google.com/schema/2")
+        ack.setAttribute("serial-number", serial_number)
+        doc.appendChild(ack)
+        return doc.toxml(encoding="utf-8")
+
+    def test_same_as_minidom(self):
+        serials = ['85f54628-538a-44fc-8605-ae62364f6c71', u'85f54628-538a-44fc-8605-ae62364f6c71',
+            '', 'a & b <c> "d" \'e\'', u'n\xfamero \u2603']
+        serials += [parse_notification(xmlstr)[1] for xmlstr in NOTIFICATIONS.values()]
+        for serial_number in serials:
+            self.assertEqual(googlecheckout.acknowledgment_xml(serial_number), self.minidom_ack(serial_number))
+
+    def test_handshake(self):
+        handler = make_handler(Handler, NOTIFICATIONS['risk-information-notification'])
+        handler.post()
+        self.assertEqual(handler.response.out.getvalue(), self.minidom_ack(handler.notification_serial_number))
+        self.assertEqual(handler.response.headers['Content-Type'], 'text/xml')
+
+if __name__ == '__main__':
+    unittest.main()